@@ -21,6 +21,16 @@ import os
 import random
 import time
 import heapq
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import tempfile
+import shutil
+import warnings
+import zipfile
+import copy
+import sys
+import traceback
 
 def sparse_to_tuple(sparse_mx):
     if not sp.isspmatrix_coo(sparse_mx):
@@ -290,6 +300,115 @@ def evaluate_overlap_torch(_N,_num_of_edges,adj_origin,embedding_matrix_numpy,li
     return predict_adj
 
 
+class LinkProbabilityCache:
+    """
+    On-disk cache of link prediction results.
+
+    Entries are compressed .npz files named by a fingerprint of the link head
+    parameters and of the embedding matrix. Reading an entry refreshes its
+    modification time and writing one evicts the least recently used entries
+    until the directory is below max_bytes.
+    """
+
+    def __init__(self,cache_dir='link_cache/',max_bytes=1<<30):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self,link_prediction_head,embeddings,*extra):
+        sha=hashlib.sha1()
+        for name,value in sorted(link_prediction_head.state_dict().items()):
+            sha.update(name.encode())
+            sha.update(value.detach().cpu().numpy().tobytes())
+        embeddings=np.ascontiguousarray(embeddings)
+        sha.update(str((embeddings.shape,embeddings.dtype.str)+extra).encode())
+        sha.update(embeddings.tobytes())
+        return sha.hexdigest()
+
+    def path(self,key):
+        return os.path.join(self.cache_dir,key+'.npz')
+
+    def get(self,key):
+        path=self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path,None)
+        with np.load(path) as loader:
+            return {name:loader[name] for name in loader.files}
+
+    def put(self,key,**arrays):
+        np.savez_compressed(self.path(key),**arrays)
+        self.evict()
+
+    def evict(self):
+        entries=[os.path.join(self.cache_dir,f) for f in os.listdir(self.cache_dir) if f.endswith('.npz')]
+        entries.sort(key=os.path.getmtime)
+        total=sum(os.path.getsize(f) for f in entries)
+        # the newest entry is always kept, even alone above max_bytes
+        while total>self.max_bytes and len(entries)>1:
+            total-=os.path.getsize(entries[0])
+            os.remove(entries.pop(0))
+
+
+def evaluate_overlap_torch_cached(_N,_num_of_edges,adj_origin,embedding_matrix_numpy,link_prediction_head,
+                                  cache,candidate_k=None,tile_size=256,num_workers=1,device='cuda'):
+    """
+    Cached counterpart of evaluate_overlap_torch.
+
+    The top-M edge set and degree vector are read from cache when the link head
+    and the embeddings are unchanged, otherwise they are scored with
+    evaluate_overlap_parallel_generate and stored. With candidate_k the
+    TopKCandidateGraph of the embeddings is cached as well and returned.
+
+    Returns
+    -------
+    predict_adj: np.array of shape (N,N)
+    candidate_graph: TopKCandidateGraph, only when candidate_k is given
+    """
+
+    key=cache.key(link_prediction_head,embedding_matrix_numpy,_num_of_edges,candidate_k)
+    entry=cache.get(key)
+    if entry is None:
+        edges,graphic_seq=evaluate_overlap_parallel_generate(_N,_num_of_edges,embedding_matrix_numpy,
+                                                             link_prediction_head,tile_size=tile_size,
+                                                             num_workers=num_workers,device=device)
+        entry={'edges':edges,'degrees':graphic_seq}
+        if candidate_k is not None:
+            candidate_graph=generate_topk_candidate_graph(_N,embedding_matrix_numpy,link_prediction_head,
+                                                          candidate_k,tile_size=tile_size,device=device)
+            entry.update(indptr=candidate_graph.indptr,indices=candidate_graph.indices,probs=candidate_graph.probs)
+        cache.put(key,**entry)
+    else:
+        print('link probability cache hit: '+key)
+
+    edges=entry['edges']
+    predict_adj=np.zeros((_N,_N)).astype(int)
+    predict_adj[edges[:,0],edges[:,1]]=1
+    predict_adj[edges[:,1],edges[:,0]]=1
+    tp=int(np.sum(predict_adj*adj_origin))
+    fp=int(np.sum(adj_origin))-tp
+    fn=int(np.sum(predict_adj))-tp
+    tn=_N*_N-tp-fp-fn
+    total_num=_N*_N
+    print('True Positve:%d, %.2f'%(tp,tp/(tp+fp)))
+    print('False Positve:%d, %.2f'%(fp,fp/(tp+fp)))
+    print('True Negative:%d, %.2f'%(tn,tn/(tn+fn)))
+    print('False Negative:%d, %.2f'%(fn,fn/(tn+fn)))
+    print('Positive:%.2f'%((tp+fp)/total_num))
+    print('Negative:%.2f'%((tn+fn)/total_num))
+    if candidate_k is None:
+        return predict_adj
+    emb=torch.Tensor(embedding_matrix_numpy.astype(float)).to(device)
+
+    def row_scorer(i):
+        with torch.no_grad():
+            return link_prediction_head(emb[i:i+1],emb)[0].cpu().numpy()
+    # the cache stores the top-k rows only, the exact fallback has to be re-attached
+    candidate_graph=TopKCandidateGraph(_N,entry['indptr'],entry['indices'],entry['probs'],row_scorer=row_scorer)
+    return predict_adj,candidate_graph
+
+
 
 
 def symmetric(directed_adjacency, clip_to_one=True):
@@ -645,6 +764,66 @@ class SupervisedGraphSage(nn.Module):
             if epoch%1000==0:
                 print('\n acc:'+str(self.train_acc(train,labels)))
 
+class LinkPredictionHead(nn.Module):
+    """
+    Pairwise readout of SupervisedGraphSage applied to whole tiles of embeddings.
+
+    Parameters
+    ----------
+    fc1: nn.Linear
+         First readout layer of the link prediction model.
+    fc2: nn.Linear or None
+         Second readout layer, None for single-layer readouts.
+    """
+
+    def __init__(self,fc1,fc2=None):
+        super(LinkPredictionHead, self).__init__()
+        self.fc1=fc1
+        self.fc2=fc2
+
+    def forward(self,x,y):
+        """Score every pair of rows of x (...,b1,d) and y (...,b2,d), returns (...,b1,b2)."""
+        if self.fc2 is None:
+            # single linear readout: sum_k w_k x_k y_k + b is a matrix product
+            out=torch.matmul(x*self.fc1.weight[0],y.transpose(-1,-2))+self.fc1.bias[0]
+            return torch.sigmoid(out)
+        out = x.unsqueeze(-2)*y.unsqueeze(-3)
+        out = self.fc1(out)
+        out = F.leaky_relu(out,0.2)
+        out = self.fc2(out)
+        return torch.sigmoid(out).squeeze(-1)
+
+    def pair_forward(self,x,y):
+        """Score row-aligned pairs of x (b,d) and y (b,d), returns (b,)."""
+        out = self.fc1(x*y)
+        if self.fc2 is not None:
+            out = F.leaky_relu(out,0.2)
+            out = self.fc2(out)
+        return torch.sigmoid(out).squeeze(-1)
+
+    def upper_bound(self,x_lo,x_hi,y_lo,y_hi):
+        """
+        Upper bound of the probability over boxes of embeddings.
+
+        x_lo, x_hi (b1,d) and y_lo, y_hi (b2,d) are per-dimension bounds of b1 and b2
+        blocks of embeddings, returns (b1,b2) bounds valid for every pair of the blocks
+        (interval propagation through the readout, sigmoid and leaky relu are monotone).
+        """
+        corners=torch.stack([x_lo.unsqueeze(1)*y_lo.unsqueeze(0),x_lo.unsqueeze(1)*y_hi.unsqueeze(0),
+                             x_hi.unsqueeze(1)*y_lo.unsqueeze(0),x_hi.unsqueeze(1)*y_hi.unsqueeze(0)])
+        z_lo=corners.min(dim=0)[0]
+        z_hi=corners.max(dim=0)[0]
+        W=self.fc1.weight
+        center=F.linear((z_lo+z_hi)/2,W,self.fc1.bias)
+        radius=F.linear((z_hi-z_lo)/2,W.abs())
+        if self.fc2 is None:
+            return torch.sigmoid(center+radius).squeeze(-1)
+        h_lo=F.leaky_relu(center-radius,0.2)
+        h_hi=F.leaky_relu(center+radius,0.2)
+        W2=self.fc2.weight
+        out=F.linear(h_hi,W2.clamp(min=0))+F.linear(h_lo,W2.clamp(max=0))+self.fc2.bias
+        return torch.sigmoid(out).squeeze(-1)
+
 class GraphSAGE:
     
     def __init__(self, _N,_M,adj_origin,adj_dic,embedding_dim):
@@ -702,6 +881,9 @@ class GraphSAGE:
         out = torch.sigmoid(out).squeeze()
         return out
 
+    def graphsage_link_prediction_head(self):
+        return LinkPredictionHead(self.graphsage.fc1,self.graphsage.fc2)
+
     def get_embeddings(self):
         embedding_matrix_torch=torch.t(self.graphsage.enc(range(_N)))
         self.embedding_matrix_numpy=embedding_matrix_torch.detach().to('cpu').numpy()
@@ -814,7 +996,16 @@ class GraphSAGE:
             
 #GAN part
             
-def generate_ecdf(embeddings):
+def generate_ecdf(embeddings,sketch=False,device='cuda'):
+    if sketch:
+        # bounded memory: the returned DistanceHistogram is callable like an ECDF
+        ecdf_embedding=pairwise_distance_histogram(embeddings,device=device)
+        print(ecdf_embedding.total())
+        _ = plt.hist(np.concatenate([[0],ecdf_embedding.edges[:-1]]), bins=30,
+                     weights=np.concatenate([[ecdf_embedding.zeros],ecdf_embedding.counts]))
+        plt.title("Histogram")
+        plt.show()
+        return ecdf_embedding
     hist=sklearn.metrics.pairwise_distances(X=embeddings, metric='euclidean').reshape(-1,1)
     print(hist.shape)
     _ = plt.hist(hist, bins=30)  # arguments are passed to np.histogram
@@ -825,6 +1016,101 @@ def generate_ecdf(embeddings):
 
 
 
+class DistanceHistogram:
+    """
+    Mergeable fixed-bin sketch of a pairwise-distance distribution.
+
+    Distances are counted in num_bins equal bins over [0,max_distance] (larger
+    ones go to the last bin), so memory does not depend on the number of pairs.
+    Exact zeros (the diagonal, collapsed samples) are kept apart in an atom, the
+    ECDF steps there and is linear inside every bin, so its error is at most the
+    mass of one bin. Sketches with the same bins can be merged and compared.
+    """
+
+    def __init__(self,max_distance,num_bins=4096):
+        self.max_distance=float(max_distance)
+        self.num_bins=num_bins
+        self.edges=np.linspace(0.0,self.max_distance,num_bins+1)
+        self.counts=np.zeros(num_bins,dtype=np.int64)
+        self.zeros=0
+
+    def update(self,distances):
+        """Add a tensor or array of distances."""
+        if isinstance(distances,torch.Tensor):
+            distances=distances.reshape(-1)
+            zero=distances==0
+            self.zeros+=int(zero.sum())
+            index=(distances[~zero]*(self.num_bins/self.max_distance)).long().clamp_(0,self.num_bins-1)
+            self.counts+=torch.bincount(index,minlength=self.num_bins).cpu().numpy()
+        else:
+            distances=np.asarray(distances).reshape(-1)
+            zero=distances==0
+            self.zeros+=int(zero.sum())
+            index=np.clip((distances[~zero]*(self.num_bins/self.max_distance)).astype(np.int64),0,self.num_bins-1)
+            self.counts+=np.bincount(index,minlength=self.num_bins)
+        return self
+
+    def _check_bins(self,other):
+        if self.num_bins!=other.num_bins or self.max_distance!=other.max_distance:
+            raise ValueError('histograms have different bins')
+
+    def merge(self,other):
+        self._check_bins(other)
+        self.counts+=other.counts
+        self.zeros+=other.zeros
+        return self
+
+    def total(self):
+        return int(self.counts.sum())+self.zeros
+
+    def _cumulative(self):
+        # P(D<=edge) at every bin edge, the zero atom is included from edge 0 on
+        return (self.zeros+np.concatenate([[0],np.cumsum(self.counts)]))/max(self.total(),1)
+
+    def cdf(self,x):
+        """ECDF P(D<=x) at x."""
+        return np.where(np.asarray(x)<0,0.0,np.interp(x,self.edges,self._cumulative()))
+
+    __call__=cdf
+
+    def quantile(self,q):
+        return np.interp(q,self._cumulative(),self.edges)
+
+    def ks_distance(self,other):
+        """KS distance to another sketch with the same bins, sup|F-G| over the bin edges."""
+        self._check_bins(other)
+        return float(np.max(np.abs(self.cdf(self.edges)-other.cdf(other.edges))))
+
+    def plot(self,label=None):
+        plt.plot(self.edges,self.cdf(self.edges),label=label)
+
+
+def pairwise_distance_histogram(x,max_distance=None,num_bins=4096,tile_size=2048,device='cuda'):
+    """
+    Stream all N^2 Euclidean distances of the rows of x (diagonal included, like
+    pairwise_distances(x).reshape(-1)) into a DistanceHistogram.
+
+    max_distance defaults to 2*max|x_i-mean|, an upper bound of every distance;
+    pass the same value for sketches that will be compared. Pairs of identical
+    rows get an exact 0, which the matmul expansion would round to a small value.
+    """
+    x=np.asarray(x)
+    duplicate=torch.as_tensor(np.unique(x,axis=0,return_inverse=True)[1].reshape(-1)).to(device)
+    centred=x-x.mean(axis=0)
+    if max_distance is None:
+        max_distance=max(2*np.sqrt(np.square(centred).sum(axis=1).max()),1e-12)
+    sketch=DistanceHistogram(max_distance,num_bins)
+    a=torch.as_tensor(centred,dtype=torch.float32).to(device)
+    a_sq=(a*a).sum(dim=1)
+    with torch.no_grad():
+        for i0 in range(0,a.shape[0],tile_size):
+            for j0 in range(0,a.shape[0],tile_size):
+                d2=a_sq[i0:i0+tile_size,None]+a_sq[None,j0:j0+tile_size]-2*torch.matmul(a[i0:i0+tile_size],a[j0:j0+tile_size].T)
+                same=duplicate[i0:i0+tile_size,None]==duplicate[None,j0:j0+tile_size]
+                sketch.update(torch.sqrt(d2.clamp_(min=0)).masked_fill_(same,0.0))
+    return sketch
+
+
 class Generator(nn.Module):
     def __init__(self,noise_dim,embedding_dim, g_hidden_dim=[],
                  batch_size=16
@@ -878,6 +1164,10 @@ class Discriminator(nn.Module):
             
     # forward method
     def forward(self, x):
+        return torch.mean(self.score(x)).view(1)
+
+    def score(self, x):
+        """Per-sample scores tanh(D(x)) of shape (b,), forward is their mean."""
         temp=self.W_down(x)
         temp=F.leaky_relu(temp,0.2)
         temp=self.fc1(temp)
@@ -888,8 +1178,7 @@ class Discriminator(nn.Module):
             temp=F.leaky_relu(temp,0.2)
             temp=self.fc3(temp)
         temp=F.tanh(temp)
-        temp=torch.mean(temp)
-        return temp.view(1)
+        return temp.view(-1)
     
 
 def sample_real_data(data,batch_size):
@@ -897,87 +1186,543 @@ def sample_real_data(data,batch_size):
     return data[idx,:]
 
 
+class RealDataSampler:
+    """
+    Batches of real embeddings drawn on the device.
+
+    The embeddings are uploaded once as a float32 tensor and every batch is an
+    index_select with indices drawn on the same device, so sampling does no host
+    work. With shuffle=False each batch holds batch_size distinct rows, like
+    sample_real_data (replacement=True draws them with torch.randint instead);
+    with shuffle=True batches are consecutive slices of a permutation redrawn
+    every epoch, so each row is seen at most once per epoch (the tail shorter than
+    a batch is dropped). Batches are written into one preallocated tensor, so a
+    batch is only valid until the next call to sample.
+    """
+
+    def __init__(self,data,batch_size,device='cuda',shuffle=False,replacement=False,seed=None):
+        self.data=torch.as_tensor(np.asarray(data),dtype=torch.float32).to(device)
+        self.batch_size=batch_size
+        self.batch=torch.empty(batch_size,self.data.shape[1],dtype=self.data.dtype,device=self.data.device)
+        self.shuffle=shuffle
+        self.replacement=replacement
+        self.generator=None
+        if seed is not None:
+            self.generator=torch.Generator(device=self.data.device)
+            self.generator.manual_seed(seed)
+        self.permutation=None
+        self.position=0
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def _indices(self):
+        n=self.data.shape[0]
+        if self.shuffle:
+            if self.permutation is None or self.position+self.batch_size>n:
+                self.permutation=torch.randperm(n,generator=self.generator,device=self.data.device)
+                self.position=0
+            idx=self.permutation[self.position:self.position+self.batch_size]
+            self.position+=self.batch_size
+            return idx
+        if self.replacement:
+            return torch.randint(0,n,(self.batch_size,),generator=self.generator,device=self.data.device)
+        return torch.randperm(n,generator=self.generator,device=self.data.device)[:self.batch_size]
+
+    def sample(self):
+        return torch.index_select(self.data,0,self._indices(),out=self.batch)
+
+
 def calc_gradient_penalty(netD, real_data, fake_data,batch_size):
     # print "real_data: ", real_data.size(), fake_data.size()
-    alpha = torch.rand(batch_size, 1)
+    alpha = torch.rand(batch_size, 1, device=real_data.device)
     alpha = alpha.expand_as(real_data)
-    alpha = alpha.cuda()
     interpolates = alpha * real_data + ((1 - alpha) * fake_data)
-    interpolates = interpolates.cuda()
     interpolates = autograd.Variable(interpolates, requires_grad=True)
     disc_interpolates = netD(interpolates)
     gradients = autograd.grad(outputs=disc_interpolates, inputs=interpolates,
-                              grad_outputs=torch.ones(disc_interpolates.size()).cuda(),
+                              grad_outputs=torch.ones_like(disc_interpolates),
                               create_graph=True, retain_graph=True, only_inputs=True)[0]
     gradients = gradients.view(gradients.size(0), -1)
     gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * 10
     return gradient_penalty
 
+def discriminator_step(netD, real_data, fake_data, gp_weight=10, score_fn=None):
+    """
+    Gradients of one WGAN-GP discriminator update in a single forward and backward.
+
+    Real, fake and interpolated batches go through netD.score concatenated, and
+    errD_real - errD_fake - gradient_penalty is backpropagated once, which gives
+    the same gradients as the three separate backward passes of gan_train with
+    calc_gradient_penalty. Runs on the device of real_data. score_fn replaces
+    netD.score, e.g. by a traced copy sharing its parameters.
+
+    Returns
+    -------
+    errD_real, errD_fake, gradient_penalty as detached tensors of shape (1,)
+    """
+    batch_size = real_data.size(0)
+    alpha = torch.rand(batch_size, 1, device=real_data.device)
+    interpolates = (alpha * real_data + (1 - alpha) * fake_data).requires_grad_(True)
+    if score_fn is None:
+        score_fn = netD.score
+    scores = score_fn(torch.cat([real_data, fake_data, interpolates]))
+    errD_real = scores[:batch_size].mean()
+    errD_fake = scores[batch_size:2*batch_size].mean()
+    # the penalty takes the gradient of the batch mean, as netD(interpolates) does
+    gradients = autograd.grad(outputs=scores[2*batch_size:].mean(), inputs=interpolates,
+                              create_graph=True, retain_graph=True, only_inputs=True)[0]
+    gradient_penalty = ((gradients.view(batch_size, -1).norm(2, dim=1) - 1) ** 2).mean() * gp_weight
+    (errD_real - errD_fake - gradient_penalty).backward()
+    return errD_real.detach().view(1), errD_fake.detach().view(1), gradient_penalty.detach().view(1)
+
 def eval_plot(netG,embedding_matrix,noise_dim,mmd_beta=1):
-    hist_real=sklearn.metrics.pairwise_distances(X=embedding_matrix, metric='euclidean').reshape(-1,)
-    ecdf_embedding_matrix = ECDF(hist_real)
-    plt.plot(ecdf_embedding_matrix.x,ecdf_embedding_matrix.y, label="graphsage embedding")
-    
-    noise=torch.randn(embedding_matrix.shape[0],noise_dim).cuda()
-    sample=netG(noise).detach().cpu().numpy()
-    hist_fake=sklearn.metrics.pairwise_distances(X=sample, metric='euclidean').reshape(-1,)
-    ecdf_generate = ECDF(hist_fake)
-    plt.plot(ecdf_generate.x,ecdf_generate.y, label="GAN generate")
-    
-    plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
-    plt.show()
-    mmd=calculate_mmd(sample,embedding_matrix,beta=mmd_beta)
-    return mmd,np.sum(hist_fake<1e-4)
+    metrics=gan_evaluate(netG,embedding_matrix,noise_dim,mmd_beta=mmd_beta,plot=True)
+    return metrics['mmd'],metrics['collapse_count']
+
+def gan_evaluate(netG,embedding_matrix,noise_dim,mmd_beta=1,distance_summary=False,num_pairs=100000,seed=0,
+                 plot=False,device='cuda'):
+    """
+    Metrics of a generator against the real embeddings, without plotting unless asked.
+
+    Parameters
+    ----------
+    distance_summary: bool
+                      Add quantiles of the real and generated pairwise distances and
+                      their KS distance, from num_pairs sampled pairs each.
+    plot: bool
+          Also plot both pairwise-distance ECDFs (from pairwise_distance_histogram),
+          as eval_plot does.
+
+    Returns
+    -------
+    dictionary with mmd, collapse (fraction of the N^2 generated pairs, diagonal
+    included, closer than 1e-4), collapse_count and, with distance_summary,
+    real_quantiles, fake_quantiles and ks
+    """
+
+    noise=torch.randn(embedding_matrix.shape[0],noise_dim).to(device)
+    with torch.no_grad():
+        sample=netG(noise).detach().cpu().numpy()
+    if plot:
+        real_sketch=pairwise_distance_histogram(embedding_matrix,device=device)
+        real_sketch.plot(label="graphsage embedding")
+        pairwise_distance_histogram(sample,device=device).plot(label="GAN generate")
+        plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
+        plt.show()
+
+    metrics={'mmd':calculate_mmd(sample,embedding_matrix,beta=mmd_beta,device=device)}
+    metrics['collapse_count']=count_close_pairs(sample,1e-4,device=device)
+    metrics['collapse']=metrics['collapse_count']/(sample.shape[0]*sample.shape[0])
+    if distance_summary:
+        rng=np.random.RandomState(seed)
+        real=sampled_pair_distances(embedding_matrix,num_pairs,rng)
+        fake=sampled_pair_distances(sample,num_pairs,rng)
+        levels=[0.05,0.25,0.5,0.75,0.95]
+        metrics['real_quantiles']=dict(zip(levels,np.quantile(real,levels).tolist()))
+        metrics['fake_quantiles']=dict(zip(levels,np.quantile(fake,levels).tolist()))
+        metrics['ks']=ks_distance(real,fake)
+    return metrics
+
+def count_close_pairs(x,eps,rows=None,tile_size=2048,device='cuda'):
+    """
+    Number of ordered pairs (diagonal included) of rows of x closer than eps,
+    as np.sum(pairwise_distances(x)<eps), in O(tile_size^2) memory. With rows,
+    only the pairs (i,j) with i in rows are counted.
+
+    Tiles are screened with float32 squared distances and every candidate near
+    the threshold is recomputed exactly in float64.
+    """
+    x=np.asarray(x,dtype=np.float64)
+    rows=np.arange(x.shape[0]) if rows is None else np.asarray(rows,dtype=np.int64)
+    a=torch.as_tensor(x,dtype=torch.float32).to(device)
+    a_sq=(a*a).sum(dim=1)
+    q=a[torch.from_numpy(rows).to(a.device)]
+    q_sq=(q*q).sum(dim=1)
+    count=0
+    with torch.no_grad():
+        for i0 in range(0,q.shape[0],tile_size):
+            for j0 in range(0,a.shape[0],tile_size):
+                d2=q_sq[i0:i0+tile_size,None]+a_sq[None,j0:j0+tile_size]-2*torch.matmul(q[i0:i0+tile_size],a[j0:j0+tile_size].T)
+                # float32 rounding of the expansion is about eps32*(|a|^2+|b|^2)
+                slack=1e-5*(q_sq[i0:i0+tile_size,None]+a_sq[None,j0:j0+tile_size])
+                r,c=torch.nonzero(d2<eps*eps+slack,as_tuple=True)
+                r=rows[r.cpu().numpy()+i0]
+                c=c.cpu().numpy()+j0
+                for k0 in range(0,len(r),65536):
+                    exact=np.square(x[r[k0:k0+65536]]-x[c[k0:k0+65536]]).sum(axis=1)
+                    count+=int(np.sum(exact<eps*eps))
+    return count
+
+def estimate_collapse_fraction(x,eps=1e-4,method='knn',num_samples=256,seed=0,device='cuda'):
+    """
+    Estimate of count_close_pairs(x,eps)/N^2 in near-linear time.
+
+    'knn' counts the eps-neighbours of num_samples random rows exactly, an
+    unbiased estimate in O(num_samples*N*d). 'hash' groups rows by cells of side
+    eps/sqrt(d), whose members are all closer than eps, and sums the squared
+    cell sizes in O(N d); it is a lower bound that is exact for duplicated rows,
+    the usual form of mode collapse.
+    """
+    x=np.asarray(x,dtype=np.float64)
+    n=x.shape[0]
+    if method=='knn':
+        rows=np.random.RandomState(seed).randint(0,n,size=num_samples)
+        return count_close_pairs(x,eps,rows=rows,device=device)/(num_samples*n)
+    if method=='hash':
+        cells=np.floor(x*(np.sqrt(x.shape[1])/eps)).astype(np.int64)
+        _,sizes=np.unique(cells,axis=0,return_counts=True)
+        return float(np.sum(sizes.astype(np.float64)**2)/(n*n))
+    raise ValueError('unknown collapse method: %s'%(method))
+
+def sampled_pair_distances(x,num_pairs,rng):
+    """Euclidean distances of num_pairs uniformly sampled ordered pairs of rows of x."""
+    i=rng.randint(0,x.shape[0],size=num_pairs)
+    j=rng.randint(0,x.shape[0],size=num_pairs)
+    return np.sqrt(np.square(x[i]-x[j]).sum(axis=1))
+
+def ks_distance(a,b):
+    """Two-sample Kolmogorov-Smirnov distance sup|F_a-F_b|."""
+    a=np.sort(a)
+    b=np.sort(b)
+    grid=np.concatenate([a,b])
+    return float(np.max(np.abs(np.searchsorted(a,grid,side='right')/len(a)-np.searchsorted(b,grid,side='right')/len(b))))
     
-def calculate_mmd(x1, x2, beta):
-    x1x1 = gaussian_kernel(x1, x1, beta)
-    x1x2 = gaussian_kernel(x1, x2, beta)
-    x2x2 = gaussian_kernel(x2, x2, beta)
-    diff = x1x1.mean() - 2 * x1x2.mean() + x2x2.mean()
+def calculate_mmd(x1, x2, beta, unbiased=False, tile_size=2048, device=None):
+    x1x1 = gaussian_kernel_mean(x1, x1, beta, unbiased=unbiased, tile_size=tile_size, device=device)
+    x1x2 = gaussian_kernel_mean(x1, x2, beta, tile_size=tile_size, device=device)
+    x2x2 = gaussian_kernel_mean(x2, x2, beta, unbiased=unbiased, tile_size=tile_size, device=device)
+    diff = x1x1 - 2 * x1x2 + x2x2
     print(x1[0:3,:5])
     print(x2[0:3,:5])
-    print(x1x1.mean())
-    print(x1x2.mean())
-    print(x2x2.mean())
+    print(x1x1)
+    print(x1x2)
+    print(x2x2)
     return diff
 
+def gaussian_kernel_mean(x1, x2, beta=1.0, unbiased=False, tile_size=2048, device=None):
+    """
+    Mean of exp(-beta*|a-b|^2) over all pairs of rows of x1 and x2, in O(tile_size^2) memory.
+
+    Squared distances are computed tile by tile in float32 with torch on device
+    (cuda when available if None), on inputs centred by their common mean to
+    limit cancellation, and the kernel sums are accumulated in float64. When x2
+    is x1 only the upper tiles are scored; unbiased then leaves the diagonal
+    out of the mean, as in the unbiased MMD estimator.
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    same = x2 is x1
+    shift = np.concatenate([x1, x2]).mean(axis=0) if not same else x1.mean(axis=0)
+    a = torch.as_tensor(np.asarray(x1 - shift), dtype=torch.float32).to(device)
+    b = a if same else torch.as_tensor(np.asarray(x2 - shift), dtype=torch.float32).to(device)
+    a_sq = (a * a).sum(dim=1)
+    b_sq = (b * b).sum(dim=1)
+    total = torch.zeros((), dtype=torch.float64, device=a.device)
+    with torch.no_grad():
+        for i0 in range(0, a.shape[0], tile_size):
+            for j0 in range(i0 if same else 0, b.shape[0], tile_size):
+                d2 = a_sq[i0:i0+tile_size, None] + b_sq[None, j0:j0+tile_size] \
+                     - 2 * torch.matmul(a[i0:i0+tile_size], b[j0:j0+tile_size].T)
+                k = torch.exp(-beta * d2.clamp_(min=0))
+                if same and i0 == j0:
+                    # the diagonal is exactly exp(0)=1
+                    k.fill_diagonal_(1.0)
+                    total += k.sum(dtype=torch.float64)
+                else:
+                    total += (2 if same else 1) * k.sum(dtype=torch.float64)
+    total = total.item()
+    n1, n2 = a.shape[0], b.shape[0]
+    if same and unbiased:
+        return (total - n1) / (n1 * (n1 - 1))
+    return total / (n1 * n2)
+
+def linear_mmd(x1, x2, beta, seed=0, device=None):
+    """
+    Linear-time unbiased MMD^2 estimate from disjoint pairs (Gretton et al. 2012).
+
+    Rows are shuffled, paired as (2i,2i+1) and every pair of pairs contributes
+    k(x,x')+k(y,y')-k(x,y')-k(x',y), so the cost is O(N d).
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    rng = np.random.RandomState(seed)
+    n = min(x1.shape[0], x2.shape[0]) // 2 * 2
+    a = torch.as_tensor(np.asarray(x1)[rng.permutation(x1.shape[0])[:n]], dtype=torch.float32).to(device)
+    b = torch.as_tensor(np.asarray(x2)[rng.permutation(x2.shape[0])[:n]], dtype=torch.float32).to(device)
+
+    def k(u, v):
+        return torch.exp(-beta * ((u - v) ** 2).sum(dim=1))
+
+    with torch.no_grad():
+        h = k(a[0::2], a[1::2]) + k(b[0::2], b[1::2]) - k(a[0::2], b[1::2]) - k(a[1::2], b[0::2])
+    return h.double().mean().item()
+
+def rff_mmd(x1, x2, beta, num_features=1024, seed=0, tile_size=8192, device=None):
+    """
+    MMD^2 with the Gaussian kernel exp(-beta*|a-b|^2) approximated by random Fourier features.
+
+    phi(x)=sqrt(2/D)cos(Wx+b) with W~N(0,2*beta*I), b~U(0,2pi), and the estimate
+    is |mean phi(x1)-mean phi(x2)|^2, the approximation of the biased MMD of
+    calculate_mmd. The same seed gives the same features, so values from
+    different epochs are comparable. Cost is O(N d D).
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    generator = torch.Generator().manual_seed(seed)
+    d = x1.shape[1]
+    W = (torch.randn(d, num_features, generator=generator) * np.sqrt(2 * beta)).to(device)
+    bias = (torch.rand(num_features, generator=generator) * 2 * np.pi).to(device)
+
+    def mean_feature(x):
+        total = torch.zeros(num_features, dtype=torch.float64, device=W.device)
+        for i0 in range(0, x.shape[0], tile_size):
+            t = torch.as_tensor(np.asarray(x[i0:i0+tile_size]), dtype=torch.float32).to(device)
+            total += torch.cos(torch.matmul(t, W) + bias).sum(dim=0, dtype=torch.float64)
+        return total * np.sqrt(2.0 / num_features) / x.shape[0]
+
+    with torch.no_grad():
+        diff = mean_feature(x1) - mean_feature(x2)
+    return (diff * diff).sum().item()
+
+def estimate_mmd(x1, x2, beta, method='exact', seed=0, device=None):
+    """MMD^2 of x1 and x2 by method 'exact' (calculate_mmd), 'linear' (linear_mmd) or 'rff' (rff_mmd)."""
+    if method == 'linear':
+        return linear_mmd(x1, x2, beta, seed=seed, device=device)
+    if method == 'rff':
+        return rff_mmd(x1, x2, beta, seed=seed, device=device)
+    if method == 'exact':
+        return calculate_mmd(x1, x2, beta, device=device)
+    raise ValueError('unknown mmd method: %s' % (method))
+
+def mmd_estimate_error(x1, x2, beta, methods=('linear', 'rff'), seed=0, device=None):
+    """
+    Error of the fast MMD estimators against the exact biased and unbiased MMD.
+
+    Returns
+    -------
+    dictionary method -> (estimate, error); 'linear' is compared with the unbiased
+    MMD it estimates, 'rff' with the biased one
+    """
+    biased = calculate_mmd(x1, x2, beta, device=device)
+    unbiased = calculate_mmd(x1, x2, beta, unbiased=True, device=device)
+    report = {'exact': (biased, 0.0), 'exact_unbiased': (unbiased, 0.0)}
+    for method in methods:
+        value = estimate_mmd(x1, x2, beta, method=method, seed=seed, device=device)
+        report[method] = (value, value - (unbiased if method == 'linear' else biased))
+    return report
+
 def gaussian_kernel(x1, x2, beta = 1.0):
     L=sklearn.metrics.pairwise_distances(x1,x2).reshape(-1)
     return np.exp(-beta*np.square(L))
     
+def compile_gan_function(module,mode,example_inputs,method='forward'):
+    """
+    module.<method> captured with static shapes by mode: 'compile' (torch.compile),
+    'jit' (torch.jit.trace) or None (eager). The compiled function shares the
+    parameters of module. When compilation is unavailable or fails on the example
+    inputs, the eager method is returned instead.
+    """
+    eager=getattr(module,method)
+    if mode is None:
+        return eager
+    try:
+        if mode=='compile':
+            compiled=torch.compile(eager,dynamic=False)
+        elif mode=='jit':
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                compiled=getattr(torch.jit.trace_module(module,{method:example_inputs}),method)
+        else:
+            raise ValueError('unknown compile mode: %s'%(mode))
+        compiled(*example_inputs)
+        return compiled
+    except Exception as e:
+        print('%s of %s.%s failed, running eagerly: %s'%(mode,type(module).__name__,method,str(e).split('\n')[0]))
+        return eager
+
+
+class GanSteps:
+    """
+    The discriminator and generator updates of gan_train, optionally on compiled graphs.
+
+    Shapes are static (batch_size rows), so mode='compile' or 'jit' captures the
+    generator, the generator-step critic and, for 'jit' only, the scores of the
+    fused discriminator step: torch.compile does not support the double backward
+    of the gradient penalty, so that part stays eager under 'compile'. The example
+    inputs are built on device, by default the device of netG's parameters.
+    """
+
+    def __init__(self,netG,netD,optimizerD,optimizerG,batch_size,noise_dim,mode=None,device=None):
+        self.netG=netG
+        self.netD=netD
+        self.optimizerD=optimizerD
+        self.optimizerG=optimizerG
+        if device is None:
+            device=next(netG.parameters()).device
+        noise=torch.zeros(batch_size,noise_dim,device=device)
+        with torch.no_grad():
+            fake=netG(noise)
+        self.generate=compile_gan_function(netG,mode,(noise,))
+        self.critic=compile_gan_function(netD,mode,(fake,))
+        self.score=netD.score
+        if mode=='jit':
+            self.score=compile_gan_function(netD,mode,(torch.cat([fake,fake,fake]),),method='score')
+
+    def d_step(self,real,noise):
+        self.netD.zero_grad()
+        with torch.no_grad():
+            fake=self.generate(noise)
+        errD_real,errD_fake,gradient_penalty=discriminator_step(self.netD,real,fake,score_fn=self.score)
+        self.optimizerD.step()
+        return errD_real,errD_fake
+
+    def g_step(self,noise):
+        self.netG.zero_grad()
+        errG=self.critic(self.generate(noise))
+        errG.backward(torch.ones_like(errG))
+        self.optimizerG.step()
+        return errG
+
+
+def benchmark_gan_steps(embedding_dim=128,batch_size=256,noise_dim=16,g_hidden_dim=[16,32,48],d_hidden_dim=[48,16],
+                        steps=200,modes=(None,'jit','compile'),device='cpu'):
+    """
+    Steps/sec of the discriminator and generator updates for every compile mode.
+
+    Returns
+    -------
+    dictionary mode -> (D steps/sec, G steps/sec), compilation time excluded
+    """
+    result={}
+    real=torch.rand(batch_size,embedding_dim,device=device)
+    noise=torch.empty(batch_size,noise_dim,device=device)
+    for mode in modes:
+        torch.manual_seed(0)
+        netG=Generator(noise_dim,embedding_dim,g_hidden_dim,batch_size).to(device)
+        netD=Discriminator(embedding_dim,d_hidden_dim,batch_size).to(device)
+        optimizerD=torch.optim.Adam(netD.parameters(),lr=1e-4,betas=(0.5,0.9),weight_decay=1e-6)
+        optimizerG=torch.optim.Adam(netG.parameters(),lr=1e-4,betas=(0.5,0.9),weight_decay=1e-6)
+        gan_steps=GanSteps(netG,netD,optimizerD,optimizerG,batch_size,noise_dim,mode=mode,device=device)
+        rates=[]
+        for step in (lambda: gan_steps.d_step(real,noise.normal_()),lambda: gan_steps.g_step(noise.normal_())):
+            for _ in range(10):
+                step()
+            start=time.time()
+            for _ in range(steps):
+                step()
+            rates.append(steps/(time.time()-start))
+        result[mode]=tuple(rates)
+        print('%s: D %.1f steps/s, G %.1f steps/s'%(mode,rates[0],rates[1]))
+    return result
+
+
+class MetricRingBuffer:
+    """
+    Last capacity values of a training scalar, kept as detached tensors on the device.
+
+    append copies into a preallocated tensor, so recording a loss neither keeps
+    its graph alive nor synchronizes with the device; values only reach the host
+    through recent and drain.
+    """
+
+    def __init__(self,capacity=10000,device='cuda'):
+        self.buffer=torch.zeros(capacity,device=device)
+        self.capacity=capacity
+        self.count=0
+        self.drained=0
+
+    def append(self,value):
+        self.buffer[self.count%self.capacity]=value.detach().reshape(())
+        self.count+=1
+
+    def __len__(self):
+        return min(self.count,self.capacity)
+
+    def _range(self,start):
+        start=max(start,self.count-self.capacity)
+        positions=np.arange(start,self.count)
+        values=self.buffer.cpu().numpy()[positions%self.capacity] if len(positions) else np.zeros(0,dtype=np.float32)
+        return positions,values
+
+    def recent(self,n=None):
+        """The last n (default all kept) values, oldest first."""
+        return self._range(0 if n is None else self.count-n)[1]
+
+    def drain(self):
+        """(steps, values) appended since the previous drain, oldest first; anything
+        already overwritten is lost."""
+        steps,values=self._range(self.drained)
+        self.drained=self.count
+        return steps,values
+
+
+TRAINING_LOG_DTYPE=np.dtype([('metric','<i1'),('step','<i8'),('value','<f4')])
+
+def append_training_log(path,buffers):
+    """Append what each buffer of a {metric index: MetricRingBuffer} dict gathered since its last drain."""
+    records=[]
+    for metric,buffer in buffers.items():
+        steps,values=buffer.drain()
+        record=np.zeros(len(steps),dtype=TRAINING_LOG_DTYPE)
+        record['metric']=metric
+        record['step']=steps
+        record['value']=values
+        records.append(record)
+    with open(path,'ab') as f:
+        np.concatenate(records).tofile(f)
+
+def load_training_log(path,names=('D','G')):
+    """Training curves written by gan_train(log_epoch=...) as {name: (steps, values)}."""
+    records=np.fromfile(path,dtype=TRAINING_LOG_DTYPE)
+    curves={}
+    for metric,name in enumerate(names):
+        record=records[records['metric']==metric]
+        curves[name]=(record['step'],record['value'])
+    return curves
+    
 def gan_train(embedding_matrix_numpy,batch_size=256,noise_dim=16,g_hidden_dim=[16,32,48],d_hidden_dim=[48,16],
              lendataloader=200,Diter=5,Giter=1,epoch_numbers=10000,eval_epoch=100,save_idx=0,learning_rate=1e-4,
-             mmd_beta=1,mmd_criterion=0.01,mmd_best_criterion=0.001,most_training_epoch_number=20000):
+             mmd_beta=1,mmd_criterion=0.01,mmd_best_criterion=0.001,most_training_epoch_number=20000,
+             shuffle=False,mmd_method='exact',mmd_epoch=10,plot=True,collapse_epoch=None,history_size=10000,
+             log_epoch=None,compile_steps=None,seed=None,best_suffix='',callback=None,device='cuda',stop_event=None):
     
     dirs = 'gan_model/'
 
     if not os.path.exists(dirs):
         os.makedirs(dirs)
             
+    if seed is not None:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
     embedding_dim=embedding_matrix_numpy.shape[1]
     netG = Generator(noise_dim,embedding_dim, g_hidden_dim,batch_size)
     netD = Discriminator(embedding_dim, d_hidden_dim,batch_size)
     
-    netD = netD.cuda()
-    netG = netG.cuda()
+    netD = netD.to(device)
+    netG = netG.to(device)
 
     optimizerD = torch.optim.Adam(netD.parameters(), lr=learning_rate, betas=(0.5, 0.9),weight_decay=1e-6)
     optimizerG = torch.optim.Adam(netG.parameters(), lr=learning_rate, betas=(0.5, 0.9),weight_decay=1e-6)
 
-    one = torch.FloatTensor([1])
-    mone = one * -1
-    one = one.cuda()
-    mone = mone.cuda()
+    gan_steps = GanSteps(netG,netD,optimizerD,optimizerG,batch_size,noise_dim,mode=compile_steps,device=device)
     
     clamp_lower, clamp_upper = -0.01,0.01
     gen_iterations = 0
-    inputv = torch.FloatTensor(batch_size, embedding_dim).cuda()
-    noise = torch.randn(batch_size, noise_dim).cuda()
-    hisD=[]
-    hisG=[]
-    h_mean=[]
+    sampler = RealDataSampler(embedding_matrix_numpy,batch_size,device=device,shuffle=shuffle)
+    # noise buffers are refilled in place with normal_()
+    noise = torch.empty(batch_size, noise_dim, device=device)
+    eval_noise = torch.empty(embedding_matrix_numpy.shape[0], noise_dim, device=device)
+    # losses as detached scalars, curves go to dirs+'curves<save_idx>.bin' every log_epoch epochs
+    hisD=MetricRingBuffer(history_size,device=device)
+    hisG=MetricRingBuffer(history_size,device=device)
+    log_path=dirs+'curves'+str(save_idx)+'.bin'
+    if log_epoch is not None and os.path.exists(log_path):
+        os.remove(log_path)
     save_number=0
     epoch=0
+    best_fast_mmd=np.inf
     accelerate=False
     best_mmd=1000
     
@@ -1005,40 +1750,18 @@ def gan_train(embedding_matrix_numpy,batch_size=256,noise_dim=16,g_hidden_dim=[1
     #             for p in netD.parameters():
     #                 p.data.clamp_(clamp_lower, clamp_upper)
     
-                data = sample_real_data(embedding_matrix_numpy,batch_size)
                 i += 1
 
-                # train with real
-                real_cpu = torch.tensor(data).float()
-                netD.zero_grad()
-                #batch_size = real_cpu.size(0)
-    
-                real_cpu = real_cpu.cuda()
-                inputv.resize_as_(real_cpu).copy_(real_cpu)
-                inputv1 = Variable(inputv)
-                errD_real = netD(inputv1)
-                errD_real.backward(one)
-
-                # train with fake
-                noise = torch.randn(batch_size, noise_dim).cuda()
+                # real, fake (netG frozen) and gradient penalty in one pass
+                inputv1 = sampler.sample()
+                noise.normal_()
                 #noise=random_generator(batch_size,noise_dim)
-                with torch.no_grad():
-                    noisev = Variable(noise) # totally freeze netG
-                    fake = Variable(netG(noisev).data)
-                inputv2 = fake
-                errD_fake = netD(inputv2)
-                errD_fake.backward(mone)
+                errD_real, errD_fake = gan_steps.d_step(inputv1, noise)
                 errD = errD_real - errD_fake
                 hisD.append(errD_real)
-                
-                # train with gradient penalty
-                gradient_penalty = -calc_gradient_penalty(netD, inputv1, inputv2,batch_size)
-                gradient_penalty.backward()
-            # print "gradien_penalty: ", gradient_penalty
 
     #             D_cost = D_real - D_fake + gradient_penalty
     #             Wasserstein_D = D_real - D_fake
-                optimizerD.step()
 
         ############################
         # (2) Update G network
@@ -1046,42 +1769,79 @@ def gan_train(embedding_matrix_numpy,batch_size=256,noise_dim=16,g_hidden_dim=[1
             for p in netD.parameters():
                 p.requires_grad = False # to avoid computation
             for j in range(Giter):
-                netG.zero_grad()
                 # in case our last batch was the tail batch of the dataloader,
                 # make sure we feed a full batch of noise
-                noise = torch.randn(batch_size, noise_dim).cuda()
+                noise.normal_()
                 #noise=random_generator(batch_size,noise_dim)
-                noisev = Variable(noise)
-                fake = netG(noisev)
-                errG = netD(fake)
-                errG.backward(one)
-                optimizerG.step()
+                errG = gan_steps.g_step(noise)
                 gen_iterations += 1
             hisG.append(errG)
         if epoch%10==0:
             print("\rEpoch:%d/%d"%(epoch,epoch_numbers),end="")
-        if epoch>0 and epoch%eval_epoch==0:
+        # asked to stop from outside (gan_train_parallel), end the run cleanly
+        if stop_event is not None and stop_event.is_set():
+            if log_epoch is not None:
+                append_training_log(log_path,{0:hisD,1:hisG})
+            return False,best_mmd
+        if log_epoch is not None and epoch%log_epoch==0:
+            append_training_log(log_path,{0:hisD,1:hisG})
+        # sampled collapse check between evaluations, same abort rule as below
+        if collapse_epoch is not None and epoch%collapse_epoch==0:
+            with torch.no_grad():
+                sample=netG(eval_noise.normal_()).cpu().numpy()
+            collapse=estimate_collapse_fraction(sample,seed=epoch,device=device)
+            if collapse>=0.5:
+                print('\rEpoch:%d collapse=%f'%(epoch,collapse))
+                if callback is not None:
+                    callback({'epoch':epoch,'mmd':None,'collapse':collapse,'saved':False})
+                if log_epoch is not None:
+                    append_training_log(log_path,{0:hisD,1:hisG})
+                return False,best_mmd
+        # cheap MMD estimate every mmd_epoch epochs, an exact evaluation is brought
+        # forward only when it may stop the run or beats every earlier estimate
+        # below mmd_criterion, otherwise evaluations stay on the eval_epoch schedule
+        fast_check=False
+        if mmd_method!='exact' and (epoch%mmd_epoch==0 or epoch%eval_epoch==0):
+            with torch.no_grad():
+                sample=netG(eval_noise.normal_()).cpu().numpy()
+            fast_mmd=estimate_mmd(sample,embedding_matrix_numpy,mmd_beta,method=mmd_method,seed=epoch,device=device)
+            fast_check=fast_mmd<mmd_best_criterion or fast_mmd<min(mmd_criterion,best_fast_mmd)
+            best_fast_mmd=min(best_fast_mmd,fast_mmd)
+        if epoch>0 and (epoch%eval_epoch==0 or fast_check):
+            # the evaluation may end the run
+            if log_epoch is not None:
+                append_training_log(log_path,{0:hisD,1:hisG})
             torch.save(netG.state_dict(), 'gan_model/netG'+str(save_idx)+'_'+str(int(save_number/10))+str(int(save_number%10))+'.pth')
             torch.save(netD.state_dict(), 'gan_model/netD'+str(save_idx)+'_'+str(int(save_number/10))+str(int(save_number%10))+'.pth')
-            mmd,histfakenumber=eval_plot(netG,embedding_matrix_numpy,noise_dim,mmd_beta=mmd_beta)
+            metrics=gan_evaluate(netG,embedding_matrix_numpy,noise_dim,mmd_beta=mmd_beta,plot=plot,device=device)
+            mmd,histfakenumber=metrics['mmd'],metrics['collapse_count']
             print('save:',save_number)
             print('mmd=%f,collapse=%f'%(mmd,histfakenumber/(embedding_matrix_numpy.shape[0]*embedding_matrix_numpy.shape[0])))
+            if mmd_method!='exact':
+                print('%s mmd=%f,error=%f'%(mmd_method,fast_mmd,fast_mmd-mmd))
+            # whether one of the branches below writes bestG<best_suffix>.pth for this mmd
+            saved=mmd<mmd_best_criterion or (mmd<mmd_criterion and accelerate==False) \
+                  or ((accelerate==True or mmd<mmd_criterion) and mmd<best_mmd)
+            if callback is not None:
+                callback({'epoch':epoch,'mmd':mmd,'collapse':metrics['collapse'],'saved':saved})
             save_number+=1
             if mmd<mmd_best_criterion:
-                torch.save(netG.state_dict(), 'gan_model/bestG.pth')
-                torch.save(netD.state_dict(), 'gan_model/bestD.pth')
+                torch.save(netG.state_dict(), 'gan_model/bestG'+best_suffix+'.pth')
+                torch.save(netD.state_dict(), 'gan_model/bestD'+best_suffix+'.pth')
                 return True,mmd
             if mmd<mmd_criterion and accelerate==False:
-                torch.save(netG.state_dict(), 'gan_model/bestG.pth')
-                torch.save(netD.state_dict(), 'gan_model/bestD.pth')
+                torch.save(netG.state_dict(), 'gan_model/bestG'+best_suffix+'.pth')
+                torch.save(netD.state_dict(), 'gan_model/bestD'+best_suffix+'.pth')
                 epoch_numbers=most_training_epoch_number
                 accelerate=True
             if accelerate==True and mmd<best_mmd:
-                torch.save(netG.state_dict(), 'gan_model/bestG.pth')
-                torch.save(netD.state_dict(), 'gan_model/bestD.pth')
+                torch.save(netG.state_dict(), 'gan_model/bestG'+best_suffix+'.pth')
+                torch.save(netD.state_dict(), 'gan_model/bestD'+best_suffix+'.pth')
                 best_mmd=mmd
             if histfakenumber>=embedding_matrix_numpy.shape[0]*embedding_matrix_numpy.shape[0]/2:
                 return False,best_mmd
+    if log_epoch is not None:
+        append_training_log(log_path,{0:hisD,1:hisG})
     if accelerate==True:
         return False,best_mmd
     
@@ -1090,49 +1850,57 @@ def gan_train(embedding_matrix_numpy,batch_size=256,noise_dim=16,g_hidden_dim=[1
             
             
             
-def evaluate_overlap_torch_generate(_N,_num_of_edges,probability_matrix_generate):
-    
-    predict_adj=np.zeros((_N,_N))
-    h=[]
-    num_h=0
-    for i in range(_N):
-        for j in range(i+1,_N):
-            nows=max(probability_matrix_generate[i][j],probability_matrix_generate[j][i])
-            if num_h<_num_of_edges:
-                heapq.heappush(h,(nows,i,j))
-                num_h=num_h+1
-            else:
-                if h[0][0]<nows:
-                    heapq.heappop(h)
-                    heapq.heappush(h,(nows,i,j))
-        print("\r%d/%d"%(i,_N),end="")
-                
-    for x in h:
-        a=x[1]
-        b=x[2]
-        predict_adj[a][b]=1
-        predict_adj[b][a]=1
-    print(h[:10])
-    
-    maxh=0
-    minh=1
-    for x in h:
-        if x[0]>maxh:
-            maxh=x[0]
-        if x[0]<minh:
-            minh=x[0]
-    print(' max: '+str(max(h))+' min: '+str(min(h)))
-    
-    graphic_seq_generate=[0 for i in range(_N)]
-    
-    tp=0
-    tn=0
-    fp=0
-    fn=0
-    for i in range(_N):
-        for j in range(_N):
-            if predict_adj[i,j]==1:
-                graphic_seq_generate[i]+=1
+def top_m_pairs_from_matrix(_N,_num_of_edges,probability_matrix_generate,tile_size=1024):
+    """
+    Top-M upper-triangle pairs of a probability matrix scored by max(P[i][j],P[j][i]).
+
+    The matrix is read in (tile_size,tile_size) blocks, so it may be a np.memmap.
+
+    Returns
+    -------
+    edges: int64 np.array of shape (M,2) with i<j, by decreasing probability
+    probs: np.array of shape (M,)
+    """
+
+    top_m=TopMEdgeBuffer(_num_of_edges,dtype=probability_matrix_generate.dtype)
+    for i0 in range(0,_N,tile_size):
+        rows=np.asarray(probability_matrix_generate[i0:i0+tile_size])
+        for j0 in range(i0,_N,tile_size):
+            block=np.maximum(rows[:,j0:j0+tile_size],
+                             np.asarray(probability_matrix_generate[j0:j0+tile_size,i0:i0+tile_size]).T)
+            keep=block>=top_m.threshold
+            if i0==j0:
+                keep&=np.triu(np.ones(block.shape,dtype=bool),k=1)
+            r,c=np.nonzero(keep)
+            top_m.push(np.stack([r+i0,c+j0],axis=1),block[r,c])
+        print("\r%d/%d"%(min(i0+tile_size,_N),_N),end="")
+    return top_m.result()
+
+
+def evaluate_overlap_torch_generate(_N,_num_of_edges,probability_matrix_generate,return_adj=False,tile_size=1024):
+    """
+    Degree sequence of the top-M pairs of a generated probability matrix.
+
+    Parameters
+    ----------
+    return_adj: bool, default False
+                Also build the dense (N,N) predict_adj of the top-M pairs.
+
+    Returns
+    -------
+    predict_adj: np.array of shape (N,N), or None unless return_adj
+    graphic_seq_generate: np.array of shape (N,)
+    """
+
+    edges,probs=top_m_pairs_from_matrix(_N,_num_of_edges,probability_matrix_generate,tile_size=tile_size)
+    print(' max: '+str(probs.max())+' min: '+str(probs.min()))
+
+    graphic_seq_generate=np.bincount(edges.reshape(-1),minlength=_N)
+    predict_adj=None
+    if return_adj:
+        predict_adj=np.zeros((_N,_N))
+        predict_adj[edges[:,0],edges[:,1]]=1
+        predict_adj[edges[:,1],edges[:,0]]=1
     return predict_adj,graphic_seq_generate
 
 
@@ -1146,99 +1914,1482 @@ def generate_probability_matrix(_N,embeddings,link_prediction_from_embedding_one
             probability_matrix_generate[j][i]=prob_i[j]
         print("\r%d/%d"%(i,_N),end="")
     return probability_matrix_generate
-    
-def revised_Havel_Hakimmi_Algorithm(_N,_num_of_edges,dic,probability_matrix_generate,graphic_seq_generate):
-    graphic_seq=[0 for i in range(_N)]
+
+
+#Sparse candidate generation part
+
+class TopKCandidateGraph:
+    """
+    CSR-like store of the k most probable partners of every node.
+
+    Row i holds indices[indptr[i]:indptr[i+1]] and their probabilities, sorted by
+    decreasing probability (ties by decreasing index, as the dense Havel-Hakimi sort).
+    """
+
+    def __init__(self,_N,indptr,indices,probs,row_scorer=None):
+        self._N=_N
+        self.indptr=indptr
+        self.indices=indices
+        self.probs=probs
+        # optional callable i -> probabilities of i against all nodes, used when a row runs out
+        self.row_scorer=row_scorer
+        # number of exact link-head evaluations spent building the store
+        self.scored_pairs=None
+
+    @classmethod
+    def from_dense_rows(cls,cand_idx,cand_prob):
+        order=np.lexsort((-cand_idx,-cand_prob),axis=-1)
+        cand_idx=np.take_along_axis(cand_idx,order,axis=-1)
+        cand_prob=np.take_along_axis(cand_prob,order,axis=-1)
+        _N,k=cand_idx.shape
+        indptr=np.arange(0,_N*k+1,k,dtype=np.int64)
+        return cls(_N,indptr,cand_idx.reshape(-1).astype(np.int64),cand_prob.reshape(-1).astype(np.float32))
+
+    def row(self,i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]],self.probs[self.indptr[i]:self.indptr[i+1]]
+
+    def full_row(self,i):
+        """All partners of i in the candidate order, rescored exactly with row_scorer."""
+        prob=np.asarray(self.row_scorer(i),dtype=np.float32)
+        idx=np.delete(np.arange(self._N),i)
+        prob=np.delete(prob,i)
+        order=np.lexsort((-idx,-prob))
+        return idx[order],prob[order]
+
+    def row_lengths(self):
+        return np.diff(self.indptr)
+
+    def pairs(self):
+        """Unique candidate pairs (i<j) with their probabilities."""
+        rows=np.repeat(np.arange(self._N,dtype=np.int64),self.row_lengths())
+        a=np.minimum(rows,self.indices)
+        b=np.maximum(rows,self.indices)
+        keys,first=np.unique(a*self._N+b,return_index=True)
+        return np.stack([keys//self._N,keys%self._N],axis=1),self.probs[first]
+
+    def nbytes(self):
+        return self.indptr.nbytes+self.indices.nbytes+self.probs.nbytes
+
+
+def candidate_k_from_degrees(_N,dic,safety_factor=2.0):
+    max_degree=max(len(dic[i]) for i in range(_N))
+    return int(min(_N-1,np.ceil(max_degree*safety_factor)))
+
+
+def select_top_m_pairs(pairs,probs,_num_of_edges):
+    """Top-M pairs by decreasing probability, ties broken by (i,j) ascending."""
+    order=np.lexsort((pairs[:,1],pairs[:,0],-probs))[:_num_of_edges]
+    return pairs[order],probs[order]
+
+
+class TopMEdgeBuffer:
+    """
+    Running top-M pairs with the same order as select_top_m_pairs.
+
+    threshold is the M-th best probability seen so far (-inf until M pairs were
+    pushed): a pair scoring below it can never enter the result. Pairs are written
+    into preallocated arrays of 2M slots and only sorted back down to M when the
+    arrays fill up, so the sorting cost is amortized over M pushed pairs.
+    """
+
+    def __init__(self,_num_of_edges,dtype=np.float32):
+        self._num_of_edges=_num_of_edges
+        self.dtype=dtype
+        self.capacity=2*max(_num_of_edges,1)
+        self.pairs=np.zeros((self.capacity,2),dtype=np.int64)
+        self.probs=np.zeros(self.capacity,dtype=dtype)
+        self.size=0
+        self.threshold=-np.inf
+
+    def tile_mask(self,tile,floor=-np.inf):
+        """
+        Entries of a torch score tile worth pushing.
+
+        Keeps the entries above the threshold that are also in the tile's own top-M
+        (ties included), so at most about M pairs leave the device per tile.
+        """
+
+        keep=tile>=max(self.threshold,floor)
+        if tile.numel()>self._num_of_edges:
+            keep&=tile>=torch.topk(tile.reshape(-1),self._num_of_edges)[0][-1]
+        return keep
+
+    def push(self,pairs,probs):
+        keep=probs>=self.threshold
+        if len(probs)>self._num_of_edges:
+            # only the chunk's own top-M, ties included, can reach the result
+            keep&=probs>=np.partition(probs,len(probs)-self._num_of_edges)[len(probs)-self._num_of_edges]
+        pairs=pairs[keep]
+        probs=probs[keep]
+        start=0
+        while start<len(probs):
+            n=min(len(probs)-start,self.capacity-self.size)
+            self.pairs[self.size:self.size+n]=pairs[start:start+n]
+            self.probs[self.size:self.size+n]=probs[start:start+n]
+            self.size+=n
+            start+=n
+            # compact when full, and once as soon as M pairs are in to get a threshold
+            if self.size==self.capacity or (self.threshold==-np.inf and self.size>=self._num_of_edges):
+                self.compact()
+
+    def compact(self):
+        M=self._num_of_edges
+        if self.size>M:
+            probs=self.probs[:self.size]
+            kth=np.partition(probs,self.size-M)[self.size-M]
+            candidate=np.where(probs>=kth)[0]
+            pairs,probs=select_top_m_pairs(self.pairs[candidate],probs[candidate],M)
+            self.pairs[:M]=pairs
+            self.probs[:M]=probs
+            self.size=M
+        if self.size>=M:
+            self.threshold=self.probs[:self.size].min()
+
+    def merge(self,other):
+        self.push(other.pairs[:other.size],other.probs[:other.size])
+
+    def result(self):
+        self.compact()
+        return select_top_m_pairs(self.pairs[:self.size],self.probs[:self.size],self._num_of_edges)
+
+
+def evaluate_overlap_bnb_generate(_N,_num_of_edges,embeddings,link_prediction_head,tile_size=256,
+                                  device='cuda',seed=0):
+    """
+    Exact top-M edges and degree sequence, skipping tiles that cannot beat the top-M.
+
+    Nodes are grouped by k-means so every tile covers similar embeddings, each tile
+    gets an upper bound from LinkPredictionHead.upper_bound on the per-dimension
+    min/max of its two blocks, and tiles are scored best bound first. Scoring stops
+    once the next bound is below the running M-th best probability.
+
+    Returns
+    -------
+    edges: np.array of shape (M,2)
+    graphic_seq_generate: np.array of shape (N,)
+    """
+
+    n_blocks=int(np.ceil(_N/tile_size))
+    _,assign=kmeans_numpy(embeddings,n_blocks,seed=seed)
+    node_order=np.argsort(assign,kind='stable')
+    emb=torch.Tensor(embeddings.astype(float)).to(device)[torch.from_numpy(node_order).to(device)]
+    node_order_t=torch.from_numpy(node_order).to(device)
+
+    with torch.no_grad():
+        lo=torch.stack([emb[b*tile_size:(b+1)*tile_size].min(dim=0)[0] for b in range(n_blocks)])
+        hi=torch.stack([emb[b*tile_size:(b+1)*tile_size].max(dim=0)[0] for b in range(n_blocks)])
+        # float32 rounding slack, bounds must never be below a computed score
+        bound=link_prediction_head.upper_bound(lo,hi,lo,hi).cpu().numpy()+1e-6
+    bi,bj=np.triu_indices(n_blocks)
+    tile_order=np.argsort(-bound[bi,bj],kind='stable')
+
+    top_m=TopMEdgeBuffer(_num_of_edges)
+    scored=0
+    with torch.no_grad():
+        for t in tile_order:
+            if bound[bi[t],bj[t]]<top_m.threshold:
+                break
+            i0,j0=bi[t]*tile_size,bj[t]*tile_size
+            tile=link_prediction_head(emb[i0:i0+tile_size],emb[j0:j0+tile_size])
+            if i0==j0:
+                tile=mask_lower_triangle(tile)
+            keep=top_m.tile_mask(tile,-1.0)
+            r,c=torch.nonzero(keep,as_tuple=True)
+            a=node_order_t[r+i0]
+            b=node_order_t[c+j0]
+            pairs=torch.stack([torch.min(a,b),torch.max(a,b)],dim=1)
+            top_m.push(pairs.cpu().numpy(),tile[keep].cpu().numpy())
+            scored+=1
+            print("\r%d/%d tiles"%(scored,len(tile_order)),end="")
+    print('\nscored %d of %d tiles'%(scored,len(tile_order)))
+
+    edges,edge_probs=top_m.result()
+    print(' max: '+str(edge_probs.max())+' min: '+str(edge_probs.min()))
+    graphic_seq_generate=np.bincount(edges.reshape(-1),minlength=_N)
+    return edges,graphic_seq_generate
+
+
+def generate_batched(generate_number,netG,link_prediction_head,_N,_num_of_edges,noise_dim,k=None,tile_size=128,
+                     device='cuda',embedding_columns=None):
+    """
+    Sample generate_number embedding sets at once and score them in a single tile pass.
+
+    The generator runs on a (K,N,noise_dim) batch and every upper-triangle tile is
+    scored for the K realizations together, so the link head weights are loaded
+    once per tile. Memory is O(K * tile_size^2 * d).
+
+    Parameters
+    ----------
+    k: int or None
+       When given, also keep a TopKCandidateGraph per realization, which
+       revised_Havel_Hakimmi_Algorithm accepts instead of a dense matrix.
+    embedding_columns: slice or None
+                       Columns of the GAN output fed to the link head (gene: slice(0,128)).
+
+    Returns
+    -------
+    List of K dictionaries with 'embeddings', 'edges' (top-M), 'degrees' and,
+    with k, 'candidate_graph'.
+    """
+
+    K=generate_number
+    with torch.no_grad():
+        noise=torch.randn(K,_N,noise_dim).to(device)
+        emb=netG(noise)
+    if embedding_columns is not None:
+        emb=emb[:,:,embedding_columns]
+    buffers=[TopMEdgeBuffer(_num_of_edges) for r in range(K)]
+    if k is not None:
+        k=min(k,_N-1)
+        best_prob=torch.full((K,_N,k),-1.0,device=device)
+        best_idx=torch.full((K,_N,k),-1,dtype=torch.long,device=device)
+
+    def merge(r0,r1,c0,scores):
+        cols=torch.arange(c0,c0+scores.shape[-1],device=device).expand(K,r1-r0,-1)
+        prob=torch.cat([best_prob[:,r0:r1],scores],dim=-1)
+        idx=torch.cat([best_idx[:,r0:r1],cols],dim=-1)
+        best_prob[:,r0:r1],best_idx[:,r0:r1]=select_topk_candidates(prob,idx,k)
+
+    with torch.no_grad():
+        for (i0,j0) in upper_triangle_tiles(_N,tile_size):
+            i1=min(i0+tile_size,_N)
+            j1=min(j0+tile_size,_N)
+            tile=link_prediction_head(emb[:,i0:i1],emb[:,j0:j1])
+            if i0==j0:
+                tile=mask_lower_triangle(tile)
+            for r in range(K):
+                keep=buffers[r].tile_mask(tile[r],0.0)
+                rows,cols=torch.nonzero(keep,as_tuple=True)
+                buffers[r].push(torch.stack([rows+i0,cols+j0],dim=1).cpu().numpy(),tile[r][keep].cpu().numpy())
+            if k is not None:
+                merge(i0,i1,j0,tile)
+                merge(j0,j1,i0,tile.transpose(-1,-2))
+            print("\r%d/%d"%(i1,_N),end="")
+
+    results=[]
+    for r in range(K):
+        edges,_=buffers[r].result()
+        result={'embeddings':emb[r].cpu().numpy(),'edges':edges,
+                'degrees':np.bincount(edges.reshape(-1),minlength=_N)}
+        if k is not None:
+            candidate_graph=TopKCandidateGraph.from_dense_rows(best_idx[r].cpu().numpy(),best_prob[r].cpu().numpy())
+            candidate_graph.scored_pairs=_N*(_N-1)//2
+
+            def row_scorer(i,emb_r=emb[r]):
+                with torch.no_grad():
+                    return link_prediction_head(emb_r[i:i+1],emb_r)[0].cpu().numpy()
+            candidate_graph.row_scorer=row_scorer
+            result['candidate_graph']=candidate_graph
+        results.append(result)
+    return results
+
+
+def select_topk_candidates(prob,idx,k):
+    """
+    Keep the k best candidates along the last dimension.
+
+    Candidates are ranked by decreasing probability with ties broken by decreasing
+    index, the order of TopKCandidateGraph.from_dense_rows and of the dense
+    Havel-Hakimi scan, so a row always is a prefix of the dense ranking. torch.topk
+    picks arbitrarily among ties at the k-th position and cannot be used directly.
+    """
+
+    order=torch.sort(idx,dim=-1,descending=True,stable=True)[1]
+    prob=torch.gather(prob,-1,order)
+    idx=torch.gather(idx,-1,order)
+    prob,order=torch.sort(prob,dim=-1,descending=True,stable=True)
+    return prob[...,:k],torch.gather(idx,-1,order[...,:k])
+
+
+def mask_lower_triangle(tile,value=-2.0):
+    """
+    Set the pairs j<=i of a diagonal tile to value.
+
+    The other scores are left bit-exact, shifting the tile up and down around
+    torch.triu would round them and reorder near ties.
+    """
+
+    keep=torch.ones(tile.shape[-2:],dtype=torch.bool,device=tile.device).triu(diagonal=1)
+    return tile.masked_fill(~keep,value)
+
+
+def upper_triangle_tiles(_N,tile_size):
+    return [(i0,j0) for i0 in range(0,_N,tile_size) for j0 in range(i0,_N,tile_size)]
+
+
+def score_tiles_parallel(_N,embeddings,link_prediction_head,consume,tile_size=256,num_workers=None,device='cpu'):
+    """
+    Score every upper-triangle tile on a thread pool.
+
+    Tiles are dealt round-robin to num_workers threads, each scoring its share in
+    order and calling consume(worker,i0,j0,tile) with pairs j<=i of diagonal tiles
+    set to -1. Torch releases the GIL inside the link head, so threads run in parallel;
+    intra-op threads are limited to one per worker meanwhile.
+    """
+
+    if num_workers is None:
+        num_workers=os.cpu_count()
+    emb=torch.Tensor(embeddings.astype(float)).to(device)
+    tiles=upper_triangle_tiles(_N,tile_size)
+    shares=[tiles[w::num_workers] for w in range(num_workers)]
+
+    def work(worker):
+        with torch.no_grad():
+            for (i0,j0) in shares[worker]:
+                tile=link_prediction_head(emb[i0:i0+tile_size],emb[j0:j0+tile_size])
+                if i0==j0:
+                    tile=mask_lower_triangle(tile,-1.0)
+                consume(worker,i0,j0,tile)
+
+    num_threads=torch.get_num_threads()
+    if num_workers>1:
+        torch.set_num_threads(1)
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            # list() re-raises worker exceptions
+            list(pool.map(work,range(num_workers)))
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+def generate_probability_matrix_parallel(_N,embeddings,link_prediction_head,tile_size=256,num_workers=None,
+                                         device='cpu'):
+    """Same matrix as generate_probability_matrix, scored by tiles on a thread pool."""
+    probability_matrix_generate=np.zeros((_N,_N))
+
+    def consume(worker,i0,j0,tile):
+        tile=tile.clamp(min=0.0).cpu().numpy()
+        probability_matrix_generate[i0:i0+tile.shape[0],j0:j0+tile.shape[1]]=tile
+        if i0==j0:
+            probability_matrix_generate[j0:j0+tile.shape[1],i0:i0+tile.shape[0]]+=tile.T
+        else:
+            probability_matrix_generate[j0:j0+tile.shape[1],i0:i0+tile.shape[0]]=tile.T
+
+    score_tiles_parallel(_N,embeddings,link_prediction_head,consume,tile_size=tile_size,
+                         num_workers=num_workers,device=device)
+    return probability_matrix_generate
+
+
+def evaluate_overlap_parallel_generate(_N,_num_of_edges,embeddings,link_prediction_head,tile_size=256,
+                                       num_workers=None,device='cpu'):
+    """
+    Top-M edges and degree sequence from tiles scored on a thread pool.
+
+    Every worker keeps its own TopMEdgeBuffer, the buffers are merged in worker
+    order and the degree sequence is counted on the merged top-M, so the result
+    does not depend on thread scheduling.
+    """
+
+    if num_workers is None:
+        num_workers=os.cpu_count()
+    buffers=[TopMEdgeBuffer(_num_of_edges) for w in range(num_workers)]
+
+    def consume(worker,i0,j0,tile):
+        keep=buffers[worker].tile_mask(tile,0.0)
+        r,c=torch.nonzero(keep,as_tuple=True)
+        pairs=torch.stack([r+i0,c+j0],dim=1)
+        buffers[worker].push(pairs.cpu().numpy(),tile[keep].cpu().numpy())
+
+    start_time=time.time()
+    score_tiles_parallel(_N,embeddings,link_prediction_head,consume,tile_size=tile_size,
+                         num_workers=num_workers,device=device)
+    top_m=buffers[0]
+    for other in buffers[1:]:
+        top_m.merge(other)
+    edges,edge_probs=top_m.result()
+    print('scoring time:%.2f, workers:%d'%(time.time()-start_time,num_workers))
+    print(' max: '+str(edge_probs.max())+' min: '+str(edge_probs.min()))
+    graphic_seq_generate=np.bincount(edges.reshape(-1),minlength=_N)
+    return edges,graphic_seq_generate
+
+
+def generate_topk_candidate_graph(_N,embeddings,link_prediction_head,k,tile_size=256,device='cuda'):
+    """
+    Stream upper-triangle score tiles and keep the top-k partners of every node.
+
+    Parameters
+    ----------
+    _N: int
+        Number of nodes.
+    embeddings: np.array of shape (N,d)
+                Generated embeddings.
+    link_prediction_head: LinkPredictionHead
+                          Pairwise scorer, see GraphSAGE.graphsage_link_prediction_head.
+    k: int
+       Number of candidates kept per node, see candidate_k_from_degrees.
+    tile_size: int
+               Side of the score tiles, memory is O(tile_size^2 * d).
+
+    Returns
+    -------
+    TopKCandidateGraph
+    """
+
+    k=min(k,_N-1)
+    emb=torch.Tensor(embeddings.astype(float)).to(device)
+    best_prob=torch.full((_N,k),-1.0,device=device)
+    best_idx=torch.full((_N,k),-1,dtype=torch.long,device=device)
+
+    def merge(r0,r1,c0,scores):
+        cols=torch.arange(c0,c0+scores.shape[1],device=device).expand(r1-r0,-1)
+        prob=torch.cat([best_prob[r0:r1],scores],dim=1)
+        idx=torch.cat([best_idx[r0:r1],cols],dim=1)
+        best_prob[r0:r1],best_idx[r0:r1]=select_topk_candidates(prob,idx,k)
+
+    with torch.no_grad():
+        for i0 in range(0,_N,tile_size):
+            i1=min(i0+tile_size,_N)
+            for j0 in range(i0,_N,tile_size):
+                j1=min(j0+tile_size,_N)
+                tile=link_prediction_head(emb[i0:i1],emb[j0:j1])
+                if j0==i0:
+                    # keep pairs i<j only, row j receives the pair through the transpose
+                    tile=mask_lower_triangle(tile)
+                merge(i0,i1,j0,tile)
+                merge(j0,j1,i0,tile.t())
+            print("\r%d/%d"%(i1,_N),end="")
+    candidate_graph=TopKCandidateGraph.from_dense_rows(best_idx.cpu().numpy(),best_prob.cpu().numpy())
+    candidate_graph.scored_pairs=_N*(_N-1)//2
+
+    def row_scorer(i):
+        with torch.no_grad():
+            return link_prediction_head(emb[i:i+1],emb)[0].cpu().numpy()
+    candidate_graph.row_scorer=row_scorer
+    return candidate_graph
+
+
+def evaluate_overlap_topk_generate(_N,_num_of_edges,candidate_graph):
+    """Top-M edges and generated degree sequence computed from a TopKCandidateGraph."""
+    pairs,probs=candidate_graph.pairs()
+    edges,edge_probs=select_top_m_pairs(pairs,probs,_num_of_edges)
+    print(' max: '+str(edge_probs.max())+' min: '+str(edge_probs.min()))
+    graphic_seq_generate=np.bincount(edges.reshape(-1),minlength=_N)
+
+    # a row whose candidates were all selected may be hiding better pairs beyond k
+    saturated=np.sum(graphic_seq_generate>=candidate_graph.row_lengths())
+    if saturated>0:
+        print('%d nodes used all their candidates, increase safety_factor for exact top-M'%(saturated))
+    return edges,graphic_seq_generate
+
+
+def kmeans_numpy(X,n_clusters,n_iter=20,seed=0):
+    """Plain Lloyd iterations, returns (centroids, assignment)."""
+    rng=np.random.RandomState(seed)
+    X=X.astype(np.float32)
+    centroids=X[rng.choice(X.shape[0],n_clusters,replace=False)].copy()
+    sq_norm=np.sum(X*X,axis=1)
+    for it in range(n_iter):
+        dist=sq_norm[:,None]-2*X.dot(centroids.T)+np.sum(centroids*centroids,axis=1)[None,:]
+        assign=np.argmin(dist,axis=1)
+        counts=np.bincount(assign,minlength=n_clusters)
+        sums=np.zeros_like(centroids)
+        np.add.at(sums,assign,X)
+        empty=counts==0
+        centroids[~empty]=sums[~empty]/counts[~empty,None]
+        # reseed empty clusters on random points
+        centroids[empty]=X[rng.choice(X.shape[0],np.sum(empty))]
+    return centroids,assign
+
+
+def generate_ivf_candidate_graph(_N,embeddings,link_prediction_head,k,n_clusters=None,n_probe=4,
+                                 tile_size=256,device='cuda',seed=0):
+    """
+    Approximate TopKCandidateGraph scoring only pairs proposed by a clustered (IVF) index.
+
+    The embeddings are clustered with k-means, every node is scored against the
+    centroids with the link head and probes its n_probe most probable clusters.
+    Exact scores are computed only against the members of the probed clusters,
+    about N^2*n_probe/n_clusters evaluations instead of N^2/2.
+
+    Parameters
+    ----------
+    n_clusters: int, default sqrt(N)
+                Number of k-means clusters.
+    n_probe: int
+             Number of clusters scored exactly for each node.
+
+    Returns
+    -------
+    TopKCandidateGraph
+    """
+
+    if n_clusters is None:
+        n_clusters=int(np.ceil(np.sqrt(_N)))
+    n_probe=min(n_probe,n_clusters)
+    k=min(k,_N-1)
+    centroids,assign=kmeans_numpy(embeddings,n_clusters,seed=seed)
+    emb=torch.Tensor(embeddings.astype(float)).to(device)
+    # members of every cluster, contiguous in cluster order
+    node_order=np.argsort(assign,kind='stable')
+    sizes=np.bincount(assign,minlength=n_clusters)
+    starts=np.concatenate([[0],np.cumsum(sizes)])
+    scored_pairs=0
+
+    cand_idx=np.full((_N,k),-1,dtype=np.int64)
+    cand_prob=np.full((_N,k),-1.0,dtype=np.float32)
+    with torch.no_grad():
+        cent=torch.Tensor(centroids).to(device)
+        for r0 in range(0,_N,tile_size):
+            rows=node_order[r0:r0+tile_size]
+            probe=torch.topk(link_prediction_head(emb[torch.from_numpy(rows).to(device)],cent),n_probe,dim=1)[1]
+            probe=probe.cpu().numpy()
+            width=int(sizes[probe].sum(axis=1).max())
+            # bound the (rows x width x d) gather to about tile_size^2 pairs
+            step=max(1,tile_size*tile_size//max(width,1))
+            for b0 in range(0,len(rows),step):
+                r=rows[b0:b0+step]
+                cols=np.full((len(r),width),-1,dtype=np.int64)
+                for t in range(len(r)):
+                    members=np.concatenate([node_order[starts[c]:starts[c+1]] for c in probe[b0+t]])
+                    cols[t,:len(members)]=members
+                scored_pairs+=int(np.sum(cols>=0))
+                cols_t=torch.from_numpy(cols).to(device)
+                y=emb[cols_t.clamp(min=0)]
+                x=emb[torch.from_numpy(r).to(device)].unsqueeze(1)
+                tile=link_prediction_head(x,y).squeeze(1)
+                tile[(cols_t<0)|(cols_t==torch.from_numpy(r).to(device)[:,None])]=-2.0
+                kk=min(k,width)
+                prob,pos=torch.topk(tile,kk,dim=1)
+                cand_prob[r,:kk]=prob.cpu().numpy()
+                cand_idx[r,:kk]=np.take_along_axis(cols,pos.cpu().numpy(),axis=1)
+            print("\r%d/%d"%(min(r0+tile_size,_N),_N),end="")
+
+    # rows with fewer than k proposals keep -1 sentinels, drop them from the CSR rows
+    valid=cand_idx>=0
+    valid&=cand_prob>-1.0
+    order=np.lexsort((-cand_idx,-cand_prob),axis=-1)
+    cand_idx=np.take_along_axis(cand_idx,order,axis=-1)
+    cand_prob=np.take_along_axis(cand_prob,order,axis=-1)
+    valid=np.take_along_axis(valid,order,axis=-1)
+    indptr=np.concatenate([[0],np.cumsum(np.sum(valid,axis=1))]).astype(np.int64)
+    candidate_graph=TopKCandidateGraph(_N,indptr,cand_idx[valid],cand_prob[valid])
+    candidate_graph.scored_pairs=scored_pairs
+
+    def row_scorer(i):
+        with torch.no_grad():
+            return link_prediction_head(emb[i:i+1],emb)[0].cpu().numpy()
+    candidate_graph.row_scorer=row_scorer
+    return candidate_graph
+
+
+def evaluate_candidate_recall(_N,_num_of_edges,embeddings,link_prediction_head,candidate_graph,
+                              exact_candidate_graph=None,k=None,tile_size=256,device='cuda'):
+    """
+    Recall of an approximate candidate graph against exhaustive scoring.
+
+    Returns
+    -------
+    Dictionary with the top-M edge recall, the mean per-node top-k recall and the
+    fraction of the N(N-1)/2 pairs the approximate graph scored exactly.
+    """
+
+    if exact_candidate_graph is None:
+        if k is None:
+            k=int(candidate_graph.row_lengths().max())
+        start_time=time.time()
+        exact_candidate_graph=generate_topk_candidate_graph(_N,embeddings,link_prediction_head,k,
+                                                            tile_size=tile_size,device=device)
+        print('\nexhaustive scoring time:%.2f'%(time.time()-start_time))
+    approx_edges,_=evaluate_overlap_topk_generate(_N,_num_of_edges,candidate_graph)
+    exact_edges,_=evaluate_overlap_topk_generate(_N,_num_of_edges,exact_candidate_graph)
+    approx_keys=approx_edges[:,0]*_N+approx_edges[:,1]
+    exact_keys=exact_edges[:,0]*_N+exact_edges[:,1]
+    recall={}
+    recall['top_m_recall']=len(np.intersect1d(approx_keys,exact_keys))/len(exact_keys)
+
+    row_recall=[]
     for i in range(_N):
-        graphic_seq[i]=len(dic[i])
-    graphic_seq.sort()
+        exact_row,_=exact_candidate_graph.row(i)
+        approx_row,_=candidate_graph.row(i)
+        kk=min(len(exact_row),len(approx_row))
+        if kk>0:
+            row_recall.append(len(np.intersect1d(exact_row[:kk],approx_row[:kk]))/kk)
+    recall['top_k_recall']=float(np.mean(row_recall))
+    if candidate_graph.scored_pairs is not None:
+        recall['scored_fraction']=candidate_graph.scored_pairs/(_N*(_N-1)/2)
+    print('top-M recall:%.4f, top-k recall:%.4f'%(recall['top_m_recall'],recall['top_k_recall']))
+    return recall
+
+
+class CandidateOrdering:
+    """
+    Lazy per-node partner rankings for Havel-Hakimi, consumed through cursors.
+
+    The ranking of a node (decreasing max(P[i][x],P[x][i]), ties by decreasing
+    index) is built on its first visit, from its TopKCandidateGraph row, from
+    SubsetProbabilityStore.partners or from a chunked argpartition of its dense row, and extended only when the cursor runs
+    out. Partners behind the cursor are saturated or already adjacent, which
+    never changes back, so a revisit resumes where the previous one stopped.
+    """
+
+    def __init__(self,probability_matrix_generate,_N,chunk_size=64):
+        self.store=probability_matrix_generate
+        self._N=_N
+        self.chunk_size=chunk_size
+        self.ranking={}
+        # dense rows: probabilities >= bound[x] are ranked already
+        self.bound={}
+        self.complete=np.zeros(_N,dtype=bool)
+        self.cursor=np.zeros(_N,dtype=np.int64)
+
+    def _extend(self,x,count):
+        """Append at least count partners (or all remaining ones) to the ranking of x."""
+        if self.complete[x]:
+            return False
+        store=self.store
+        ranking=self.ranking.get(x,np.zeros(0,dtype=np.int64))
+        if isinstance(store,SubsetProbabilityStore):
+            self.ranking[x]=store.partners(x)
+            self.complete[x]=True
+            return len(self.ranking[x])>0
+        if isinstance(store,TopKCandidateGraph):
+            if x not in self.ranking:
+                new=store.row(x)[0]
+                self.complete[x]=store.row_scorer is None or len(new)>=self._N-1
+            else:
+                # top-k row exhausted, append the rest of the exact row
+                full=store.full_row(x)[0]
+                new=full[~np.isin(full,ranking)]
+                self.complete[x]=True
+            self.ranking[x]=np.concatenate([ranking,new])
+            return len(new)>0
+
+        prob=np.maximum(store[:,x],store[x,:])
+        idx=np.where(prob<self.bound.get(x,np.inf))[0]
+        idx=idx[idx!=x]
+        if len(idx)>count:
+            # whole tie group of the count-th value, so chunks keep the exact order
+            value=np.partition(prob[idx],len(idx)-count)[len(idx)-count]
+            idx=idx[prob[idx]>=value]
+            self.bound[x]=value
+        else:
+            self.complete[x]=True
+        idx=idx[np.lexsort((-idx,-prob[idx]))]
+        self.ranking[x]=np.concatenate([ranking,idx])
+        return len(idx)>0
+
+    def next_partners(self,x,need,residual,adjacent):
+        """First need partners of x after the cursor with residual>0 and not adjacent[y]."""
+        chosen=[]
+        while need>0:
+            ranking=self.ranking.get(x)
+            if ranking is None or self.cursor[x]>=len(ranking):
+                if not self._extend(x,max(self.chunk_size,2*need)):
+                    break
+                continue
+            window=ranking[self.cursor[x]:self.cursor[x]+max(self.chunk_size,2*need)]
+            ok=np.where((residual[window]>0)&~adjacent[window])[0][:need]
+            chosen.append(window[ok])
+            need-=len(ok)
+            self.cursor[x]+=ok[-1]+1 if need==0 else len(window)
+        if len(chosen)==0:
+            return np.zeros(0,dtype=np.int64)
+        return np.concatenate(chosen)
+
+
+def is_graphical(degrees):
+    """
+    Erdos-Gallai test of a degree sequence in O(N log N) (O(N) after the sort).
+
+    Returns
+    -------
+    -1 if the sequence is graphical, 0 if its sum is odd, otherwise the first
+    k (1-based, on the decreasing sequence) violating the inequality
+    sum_{i<=k} d_i <= k(k-1) + sum_{i>k} min(d_i,k).
+    """
+
+    d=np.sort(np.asarray(degrees,dtype=np.int64))[::-1]
+    n=len(d)
+    if n==0:
+        return -1
+    if d.sum()%2==1:
+        return 0
+    k=np.arange(1,n+1)
+    prefix=np.cumsum(d)
+    suffix=np.concatenate([np.cumsum(d[::-1])[::-1],[0]])
+    # number of degrees >= k, the decreasing order makes min(d_i,k)=k exactly for i<p_k
+    p=n-np.searchsorted(d[::-1],k,side='left')
+    split=np.maximum(p,k)
+    rhs=k*(k-1)+k*np.maximum(p-k,0)+suffix[split]
+    violated=np.where(prefix>rhs)[0]
+    if len(violated)==0:
+        return -1
+    return int(violated[0]+1)
+
+
+def allocate_degree_sequence(_N,dic,graphic_seq_generate,graphical='raise'):
+    """
+    Assign the original degree sequence to the generated nodes by rank.
+
+    The node with the i-th smallest generated degree (ties by index) gets the
+    i-th smallest original degree.
+
+    Parameters
+    ----------
+    graphical: str, default 'raise'
+               'raise' to fail fast on a non-graphical sequence, 'repair' to lower
+               the largest degrees until it is graphical, 'ignore' to skip the check.
+
+    Returns
+    -------
+    np.array of shape (N,) with the target degree of every node.
+    """
+
+    graphic_seq=np.sort(np.array([len(dic[i]) for i in range(_N)],dtype=np.int64))
     print(len(graphic_seq))
     print(graphic_seq[:10])
     print(graphic_seq[:-11:-1])
+    if graphical!='ignore':
+        violated=is_graphical(graphic_seq)
+        if violated>=0 and graphical=='raise':
+            raise ValueError('degree sequence is not graphical (Erdos-Gallai fails at k=%d)'%(violated))
+        repaired=0
+        while violated>=0:
+            # degrees are kept ascending, the largest ones sit at the end
+            if violated==0:
+                graphic_seq[-1]-=1
+            else:
+                graphic_seq[-2:]-=1
+            graphic_seq.sort()
+            repaired+=1
+            violated=is_graphical(graphic_seq)
+        if repaired>0:
+            print('degree sequence repaired in %d steps, %d edges'%(repaired,graphic_seq.sum()//2))
+
+    allocate_order=np.argsort(np.asarray(graphic_seq_generate),kind='stable')
+    target_degree=np.zeros(_N,dtype=np.int64)
+    target_degree[allocate_order]=graphic_seq
+    return target_degree
+
+
+def havel_hakimi_edge_chunks(_N,_num_of_edges,target_degree,probability_matrix_generate,chunk_edges=65536,
+                             skip_stalled=False):
+    """
+    Havel-Hakimi realization of target_degree as an iterator of edge chunks.
+
+    Edges are yielded as soon as at least chunk_edges of them are committed,
+    as int64 arrays of shape (b,2) with i<j, in the order
+    revised_Havel_Hakimmi_Algorithm(output='edges') returns them. The loop stops
+    at the first node that finds no partner, unless skip_stalled drops that
+    node's residual degree and goes on with the next one.
+
+    Only the output is buffered in bounded chunks: the adjacency built so far is
+    still kept, as int32 neighbor slots preallocated from target_degree (4 bytes
+    per edge endpoint, O(M) memory).
+    """
+    # node x owns neighbor[neighbor_ptr[x]:neighbor_ptr[x]+neighbor_count[x]]
+    neighbor_ptr=np.concatenate([[0],np.cumsum(target_degree)]).astype(np.int64)
+    neighbor=np.zeros(neighbor_ptr[-1],dtype=np.int32)
+    neighbor_count=np.zeros(_N,dtype=np.int64)
+    pending=[]
+    pending_edges=0
+
+    # residual degrees in a lazy max-heap keyed by (residual, node), ties by the
+    # larger node first; entries whose residual changed since are skipped
+    residual=np.asarray(target_degree,dtype=np.int64).copy()
+    heap=[(-residual[x],-x) for x in range(_N)]
+    heapq.heapify(heap)
+    adjacent=np.zeros(_N,dtype=bool)
+    ordering=CandidateOrdering(probability_matrix_generate,_N)
 
-    allocate_graphic_seq=[]
-    for i in range(_N):
-        allocate_graphic_seq.append((graphic_seq_generate[i],i))
-    allocate_graphic_seq.sort()
-    print(allocate_graphic_seq[:10])
-    print(allocate_graphic_seq[:-11:-1])
-    
-    degree_of_generate=[[0,0] for i in range(_N)]
-    for i in range(_N):
-        x=allocate_graphic_seq[i][1]
-        degree_of_generate[x][0]=graphic_seq[i]
-        degree_of_generate[x][1]=x
-    degree_of_generate.sort()
-    degree_of_generate=degree_of_generate[::-1]
-    print(degree_of_generate[:10])
-    print(degree_of_generate[:-11:-1])
-    
-    adj_list_generate={}
-    for i in range(_N):
-        adj_list_generate[i]=[]
-    
     remain_edge=_num_of_edges
-    while(1):
-        location_in_generate={}
-        for i in range(_N):
-            temp=degree_of_generate[i][1]
-            location_in_generate[temp]=i
-    
-    
-        x=degree_of_generate[0][1]
-        adj_number=degree_of_generate[0][0]
-        prob_xadj_arr=[]
-        
-        for i in range(_N):
-            if not i==x:
-                nowprob=max(probability_matrix_generate[i][x],probability_matrix_generate[x][i])
-                prob_xadj_arr.append((nowprob,i))
-        
-        prob_xadj_arr.sort()
-        prob_xadj_arr=prob_xadj_arr[::-1]
-        i=0
-        add_edge=False
-        while(i<_N-1):
-            y=prob_xadj_arr[i][1]
-            locaty=location_in_generate[y]
-            
-            if adj_number<=0:
-                break
-            if degree_of_generate[locaty][0]>0 and (y not in adj_list_generate[x]):
-                adj_list_generate[x].append(y)
-                adj_list_generate[y].append(x)
-                adj_number-=1
-                remain_edge=remain_edge-1
-                add_edge=True
-            i=i+1
-        degree_of_generate=[[0,0] for i in range(_N)]
-        for i in range(_N):
-            temp=allocate_graphic_seq[i][1]
-            degree_of_generate[temp][0]=graphic_seq[i]-len(adj_list_generate[temp])
-            degree_of_generate[temp][1]=temp
-        degree_of_generate.sort()
-        degree_of_generate=degree_of_generate[::-1]
-        print('\r remain_edge:%d,x=%d'%(remain_edge,x),end="")
-        if add_edge==False:
+    iteration=0
+    while(heap):
+        neg_degree,neg_x=heapq.heappop(heap)
+        x=-neg_x
+        if -neg_degree!=residual[x]:
+            continue
+        adj_number=residual[x]
+        chosen=np.zeros(0,dtype=np.int64)
+        if adj_number>0:
+            neighbors=neighbor[neighbor_ptr[x]:neighbor_ptr[x]+neighbor_count[x]]
+            adjacent[neighbors]=True
+            chosen=ordering.next_partners(x,adj_number,residual,adjacent)
+            adjacent[neighbors]=False
+        neighbor[neighbor_ptr[x]+neighbor_count[x]:neighbor_ptr[x]+neighbor_count[x]+len(chosen)]=chosen
+        neighbor_count[x]+=len(chosen)
+        neighbor[neighbor_ptr[chosen]+neighbor_count[chosen]]=x
+        neighbor_count[chosen]+=1
+        for y in chosen.tolist():
+            heapq.heappush(heap,(-(residual[y]-1),-y))
+        residual[chosen]-=1
+        if len(chosen)>0:
+            pending.append(np.stack([np.minimum(chosen,x),np.maximum(chosen,x)],axis=1))
+            pending_edges+=len(chosen)
+        residual[x]-=len(chosen)
+        heapq.heappush(heap,(-residual[x],-x))
+        if pending_edges>=chunk_edges:
+            yield np.concatenate(pending)
+            pending=[]
+            pending_edges=0
+        remain_edge=remain_edge-len(chosen)
+        iteration+=1
+        if iteration%100==0:
+            print('\r remain_edge:%d,x=%d'%(remain_edge,x),end="")
+        if len(chosen)==0:
+            if skip_stalled and adj_number>0:
+                residual[x]=0
+                continue
             break
         if remain_edge<=0:
             break
-    adj_graphic_sq_generate=np.zeros((_N,_N))
-    for i in range(_N):
-        for j in adj_list_generate[i]:
-            adj_graphic_sq_generate[i][j]=1
-            
-    print(np.sum(adj_graphic_sq_generate))
-    sum_diag=0
-    for i in range(_N):
-        sum_diag+=adj_graphic_sq_generate[i][i]
-    print(sum_diag)
-    
-    sum_symm=0
-    for i in range(_N):
-        for j in range(i+1,_N):
-            if adj_graphic_sq_generate[i][j]==1 and adj_graphic_sq_generate[i][j]==adj_graphic_sq_generate[j][i]:
-                sum_symm+=1
-    print(sum_symm)
-    return adj_graphic_sq_generate
+    if pending:
+        yield np.concatenate(pending)
+    if remain_edge>0 and isinstance(probability_matrix_generate,TopKCandidateGraph) \
+            and probability_matrix_generate.row_scorer is None:
+        warnings.warn('Havel-Hakimi stalled with %d edges left: the TopKCandidateGraph has no row_scorer '
+                      'to extend exhausted top-k rows, raise k or attach one'%(remain_edge))
+
+
+def revised_Havel_Hakimmi_Algorithm(_N,_num_of_edges,dic,probability_matrix_generate,graphic_seq_generate,
+                                    output='dense',graphical='raise'):
+    """
+    Degree-constrained realization of the generated link probabilities.
+
+    Parameters
+    ----------
+    output: str, default 'dense'
+            'dense' for an (N,N) np.array, 'edges' for an int64 (M,2) array with
+            i<j, 'csr' for a scipy.sparse.csr_matrix or 'chunks' for the iterator
+            of havel_hakimi_edge_chunks.
+    graphical: str, default 'raise'
+               What to do with a non-graphical target degree sequence, see
+               allocate_degree_sequence.
+    """
+    target_degree=allocate_degree_sequence(_N,dic,graphic_seq_generate,graphical=graphical)
+    if output=='chunks':
+        return havel_hakimi_edge_chunks(_N,_num_of_edges,target_degree,probability_matrix_generate)
+    edge_chunks=list(havel_hakimi_edge_chunks(_N,_num_of_edges,target_degree,probability_matrix_generate))
+    edges=np.concatenate(edge_chunks) if edge_chunks else np.zeros((0,2),dtype=np.int64)
+
+    # O(M) checks: edge count (both directions), self-loops, distinct undirected edges
+    print(2*len(edges))
+    print(int(np.sum(edges[:,0]==edges[:,1])))
+    print(len(np.unique(edges[:,0]*_N+edges[:,1])))
+    if output=='edges':
+        return edges
+    adj_graphic_sq_generate=sp.csr_matrix((np.ones(2*len(edges)),
+                                           (np.concatenate([edges[:,0],edges[:,1]]),
+                                            np.concatenate([edges[:,1],edges[:,0]]))),shape=(_N,_N))
+    if output=='csr':
+        return adj_graphic_sq_generate
+    return adj_graphic_sq_generate.toarray()
     
+
+
+#Incremental regeneration part
+
+class SubsetProbabilityStore:
+    """
+    Link probabilities of the pairs touching a node subset S, kept as (|S|,N) rows.
+
+    Used by CandidateOrdering for a localized Havel-Hakimi: nodes of S may pair
+    with every node, the other nodes only with nodes of S.
+    """
+
+    def __init__(self,_N,subset,rows):
+        self._N=_N
+        self.subset=np.asarray(subset,dtype=np.int64)
+        self.rows=rows
+        self.position=np.full(_N,-1,dtype=np.int64)
+        self.position[self.subset]=np.arange(len(self.subset))
+
+    @classmethod
+    def from_embeddings(cls,_N,subset,embeddings,link_prediction_head,tile_size=256,device='cuda'):
+        """Score the |S|xN pairs with the link head, tile_size rows of S at a time."""
+        subset=np.asarray(subset,dtype=np.int64)
+        emb=torch.Tensor(embeddings.astype(float)).to(device)
+        rows=np.zeros((len(subset),_N),dtype=np.float32)
+        with torch.no_grad():
+            for s0 in range(0,len(subset),tile_size):
+                index=torch.from_numpy(subset[s0:s0+tile_size]).to(device)
+                rows[s0:s0+tile_size]=link_prediction_head(emb[index],emb).cpu().numpy()
+        return cls(_N,subset,rows)
+
+    def partners(self,x):
+        """Allowed partners of x by decreasing probability, ties by decreasing index."""
+        p=self.position[x]
+        if p>=0:
+            prob=self.rows[p].copy()
+            prob[self.subset]=np.maximum(prob[self.subset],self.rows[:,x])
+            idx=np.delete(np.arange(self._N),x)
+            prob=np.delete(prob,x)
+        else:
+            idx=self.subset
+            prob=self.rows[:,x]
+        return idx[np.lexsort((-idx,-prob))]
+
+    def nbytes(self):
+        return self.rows.nbytes
+
+
+def regenerate_subset(_N,edges,subset,embeddings,link_prediction_head,target_degree=None,tile_size=256,
+                      device='cuda'):
+    """
+    Resample the edges touching a node subset, keeping the rest of the graph fixed.
+
+    All edges incident to the subset S are removed, which frees their endpoint
+    stubs. Only the |S|xN probabilities touching S are rescored from embeddings
+    (with the new rows of S), and a localized degree-constrained assignment
+    reconnects the freed stubs: those outside S to their most probable nodes of S,
+    then the rest of S among itself with Havel-Hakimi. Degrees
+    are preserved (unless target_degree is given for the nodes of S) up to
+    stubs left without any admissible partner, which are dropped.
+
+    Parameters
+    ----------
+    edges: int np.array of shape (M,2)
+           The current generated graph.
+    subset: array of node indices
+    embeddings: np.array of shape (N,d)
+                Embeddings of all nodes, the link-head inputs.
+    target_degree: np.array of shape (N,) or None
+                   New degrees of the nodes of S (other entries are ignored).
+
+    Returns
+    -------
+    int64 np.array of shape (M',2) with i<j: the fixed edges followed by the new ones
+    """
+
+    edges=np.asarray(edges,dtype=np.int64)
+    subset=np.unique(np.asarray(subset,dtype=np.int64))
+    in_subset=np.zeros(_N,dtype=bool)
+    in_subset[subset]=True
+    touched=in_subset[edges[:,0]]|in_subset[edges[:,1]]
+    fixed=edges[~touched]
+    residual=np.bincount(edges[touched].reshape(-1),minlength=_N).astype(np.int64)
+    if target_degree is not None:
+        residual[subset]=np.asarray(target_degree,dtype=np.int64)[subset]
+    print('regenerate %d nodes, %d edges removed'%(len(subset),int(touched.sum())))
+
+    store=SubsetProbabilityStore.from_embeddings(_N,subset,embeddings,link_prediction_head,
+                                                 tile_size=tile_size,device=device)
+
+    # stubs outside S can only go to S, so they are matched first (largest residual
+    # first); Havel-Hakimi then pairs what is left of S among itself
+    chunks=[]
+    ordering=CandidateOrdering(store,_N)
+    adjacent=np.zeros(_N,dtype=bool)
+    outside=np.where((residual>0)&~in_subset)[0]
+    for x in outside[np.lexsort((-outside,-residual[outside]))].tolist():
+        chosen=ordering.next_partners(x,residual[x],residual,adjacent)
+        residual[chosen]-=1
+        residual[x]-=len(chosen)
+        chunks.append(np.stack([np.minimum(chosen,x),np.maximum(chosen,x)],axis=1))
+    residual[~in_subset]=0
+    chunks.extend(havel_hakimi_edge_chunks(_N,int(residual.sum()//2),residual,store,skip_stalled=True))
+    new=np.concatenate(chunks) if chunks else np.zeros((0,2),dtype=np.int64)
+    fixed=np.stack([fixed.min(axis=1),fixed.max(axis=1)],axis=1)
+    return np.concatenate([fixed,new])
+
+
+#Edge streaming part
+
+class EdgeFileSink:
+    """
+    Append edge chunks to a raw binary file of int64 (i,j) pairs.
+
+    The file can be read while it is still being written, see load_edges.
+    """
+
+    def __init__(self,path,append=False):
+        self.path=path
+        self.file=open(path,'ab' if append else 'wb')
+        self.num_of_edges=0
+
+    def write(self,edges):
+        edges=np.ascontiguousarray(edges,dtype=np.int64)
+        edges.tofile(self.file)
+        self.file.flush()
+        self.num_of_edges+=len(edges)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+class NpzEdgeSink:
+    """
+    Write edge chunks incrementally into a .npz archive.
+
+    Every chunk becomes its own member edges_00000, edges_00001, ... so
+    nothing is held in memory; keyword arrays given to close (e.g. labels,
+    embeddings) are stored next to them. load_edges concatenates the chunks.
+    """
+
+    def __init__(self,path):
+        self.path=path
+        self.zip_file=zipfile.ZipFile(path,'w',compression=zipfile.ZIP_STORED,allowZip64=True)
+        self.num_of_chunks=0
+        self.num_of_edges=0
+
+    def _write_array(self,name,array):
+        with self.zip_file.open(name+'.npy','w',force_zip64=True) as member:
+            np.lib.format.write_array(member,np.asanyarray(array),allow_pickle=False)
+
+    def write(self,edges):
+        self._write_array('edges_%05d'%(self.num_of_chunks),np.asarray(edges,dtype=np.int64))
+        self.num_of_chunks+=1
+        self.num_of_edges+=len(edges)
+
+    def close(self,**arrays):
+        for name,array in arrays.items():
+            if array is not None:
+                self._write_array(name,array)
+        self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+def open_edge_sink(path):
+    """NpzEdgeSink for a .npz path, EdgeFileSink otherwise."""
+    if path.endswith('.npz'):
+        return NpzEdgeSink(path)
+    return EdgeFileSink(path)
+
+
+def write_edge_chunks(edge_chunks,sink):
+    """Drain an iterator of (b,2) edge chunks into sink, returns the number of edges written."""
+    num_of_edges=0
+    for edges in edge_chunks:
+        sink.write(edges)
+        num_of_edges+=len(edges)
+    return num_of_edges
+
+
+def load_edges(path,mmap=False):
+    """
+    Read the edges written by EdgeFileSink or NpzEdgeSink (or a plain np.save).
+
+    Returns
+    -------
+    int64 np.array of shape (M,2), a read-only np.memmap for a binary edge
+    file when mmap is True
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            names=sorted(name for name in data.files if name.startswith('edges'))
+            chunks=[data[name] for name in names]
+        return np.concatenate(chunks) if chunks else np.zeros((0,2),dtype=np.int64)
+    if path.endswith('.npy'):
+        return np.load(path)
+    if mmap:
+        if os.path.getsize(path)==0:
+            return np.zeros((0,2),dtype=np.int64)
+        return np.memmap(path,dtype=np.int64,mode='r').reshape(-1,2)
+    return np.fromfile(path,dtype=np.int64).reshape(-1,2)
+
+
+#Chung-Lu sampling part
+
+class AliasTable:
+    """Walker/Vose alias table, O(N) to build and O(1) per sample."""
+
+    def __init__(self,weights):
+        weights=np.asarray(weights,dtype=np.float64)
+        n=len(weights)
+        scaled=weights*n/weights.sum()
+        self.prob=np.ones(n)
+        self.alias=np.arange(n)
+        small=[i for i in range(n) if scaled[i]<1.0]
+        large=[i for i in range(n) if scaled[i]>=1.0]
+        while small and large:
+            s_i=small.pop()
+            l_i=large.pop()
+            self.prob[s_i]=scaled[s_i]
+            self.alias[s_i]=l_i
+            scaled[l_i]=scaled[l_i]+scaled[s_i]-1.0
+            if scaled[l_i]<1.0:
+                small.append(l_i)
+            else:
+                large.append(l_i)
+
+    def sample(self,size,rng):
+        idx=rng.randint(0,len(self.prob),size=size)
+        return np.where(rng.rand(size)<self.prob[idx],idx,self.alias[idx])
+
+
+def estimate_expected_degrees(_N,embeddings,link_prediction_head,num_samples=256,seed=0,device='cuda'):
+    """Expected degree of every node from its probabilities to num_samples random nodes, O(N*num_samples)."""
+    rng=np.random.RandomState(seed)
+    emb=torch.Tensor(embeddings.astype(float)).to(device)
+    partners=torch.from_numpy(rng.randint(0,_N,size=min(num_samples,_N))).to(device)
+    degrees=np.zeros(_N)
+    with torch.no_grad():
+        for i0 in range(0,_N,256):
+            degrees[i0:i0+256]=link_prediction_head(emb[i0:i0+256],emb[partners]).sum(dim=1).cpu().numpy()
+    return degrees*_N/len(partners)
+
+
+def chung_lu_sample(_N,target_degree,embeddings,link_prediction_head,seed=0,max_rounds=100,device='cuda'):
+    """
+    Sample a simple graph close to target_degree in O(M log N).
+
+    Endpoints are drawn independently from an alias table over the residual
+    degrees (Chung-Lu), and a drawn pair is accepted with its link probability
+    relative to the best pair of the round. Self-loops, repeated edges and
+    endpoints without residual degree are rejected. Degrees are matched in
+    expectation, not exactly as with revised_Havel_Hakimmi_Algorithm.
+
+    Yields
+    ------
+    int64 np.array of shape (b,2) with the edges accepted in every round
+    """
+
+    rng=np.random.RandomState(seed)
+    emb=torch.Tensor(embeddings.astype(float)).to(device)
+    residual=np.asarray(target_degree,dtype=np.int64).copy()
+    existing=set()
+    for round_number in range(max_rounds):
+        remaining=int(residual.sum()//2)
+        if remaining<=0 or np.count_nonzero(residual)<2:
+            break
+        table=AliasTable(residual)
+        u=table.sample(2*remaining,rng)
+        v=table.sample(2*remaining,rng)
+        a=np.minimum(u,v)
+        b=np.maximum(u,v)
+        fresh=a!=b
+        a,b=a[fresh],b[fresh]
+        if len(a)==0:
+            continue
+        with torch.no_grad():
+            prob=link_prediction_head.pair_forward(emb[torch.from_numpy(a).to(device)],
+                                                   emb[torch.from_numpy(b).to(device)]).cpu().numpy()
+        accept=rng.rand(len(prob))*prob.max()<prob
+        accepted=[]
+        for x,y in zip(a[accept].tolist(),b[accept].tolist()):
+            if residual[x]>0 and residual[y]>0 and (x*_N+y) not in existing:
+                existing.add(x*_N+y)
+                residual[x]-=1
+                residual[y]-=1
+                accepted.append((x,y))
+        print('\r remain_edge:%d'%(residual.sum()//2),end="")
+        if accepted:
+            yield np.array(accepted,dtype=np.int64)
+
+
+#Parallel generation part
+
+_generate_worker_state={}
+
+def _generate_worker_init(state):
+    _generate_worker_state.update(state)
+    torch.set_num_threads(state['threads_per_worker'])
+    # realizations report through their return values, keep worker logs quiet
+    sys.stdout=open(os.devnull,'w')
+
+
+def generate_one(idx,netG,link_prediction_head,_N,_num_of_edges,dic,noise_dim,seed=0,adj_origin=None,
+                 embedding_columns=None,probability_path=None,tile_size=256,device='cpu',engine='havel_hakimi',
+                 edge_path=None):
+    """
+    One realization: GAN embeddings, probability matrix, top-M degrees, Havel-Hakimi.
+
+    The random stream of realization idx is the idx-th child of
+    np.random.SeedSequence(seed), so results do not depend on which process
+    runs it. The (N,N) probability matrix is written to a np.memmap at
+    probability_path (a temporary file when None, removed afterwards).
+
+    engine='chung_lu' replaces the last three steps by chung_lu_sample on
+    degrees allocated from estimate_expected_degrees, without any N^2 pass.
+
+    With edge_path the edges are streamed chunk by chunk into
+    open_edge_sink(edge_path) as they are committed instead of being collected;
+    the Havel-Hakimi adjacency itself is still held, see havel_hakimi_edge_chunks.
+
+    Returns
+    -------
+    edges: int64 np.array of shape (M,2), edge_path when streaming
+    metrics: dictionary of compute_graph_statistics plus edge_overlap, or None
+             without adj_origin or when streaming
+    """
+
+    child=np.random.SeedSequence(seed).spawn(idx+1)[idx]
+    generator=torch.Generator().manual_seed(int(child.generate_state(1)[0]))
+    with torch.no_grad():
+        noise=torch.randn(_N,noise_dim,generator=generator).to(device)
+        generate_data=netG(noise).detach().to('cpu').numpy()
+    if embedding_columns is not None:
+        generate_data=generate_data[:,embedding_columns]
+
+    if engine=='chung_lu':
+        expected_degree=estimate_expected_degrees(_N,generate_data,link_prediction_head,
+                                                  seed=int(child.generate_state(2)[1]),device=device)
+        target_degree=allocate_degree_sequence(_N,dic,expected_degree)
+        chunks=chung_lu_sample(_N,target_degree,generate_data,link_prediction_head,
+                               seed=int(child.generate_state(3)[2]),device=device)
+        return _collect_edges(_N,chunks,adj_origin,edge_path)
+
+    temporary=probability_path is None
+    if temporary:
+        handle,probability_path=tempfile.mkstemp(suffix='.dat')
+        os.close(handle)
+    probability_matrix_generate=np.memmap(probability_path,dtype=np.float64,mode='w+',shape=(_N,_N))
+    top_m=TopMEdgeBuffer(_num_of_edges)
+
+    def consume(worker,i0,j0,tile):
+        keep=top_m.tile_mask(tile,0.0)
+        r,c=torch.nonzero(keep,as_tuple=True)
+        top_m.push(torch.stack([r+i0,c+j0],dim=1).cpu().numpy(),tile[keep].cpu().numpy())
+        tile=tile.clamp(min=0.0).cpu().numpy()
+        probability_matrix_generate[i0:i0+tile.shape[0],j0:j0+tile.shape[1]]=tile
+        if i0==j0:
+            probability_matrix_generate[j0:j0+tile.shape[1],i0:i0+tile.shape[0]]+=tile.T
+        else:
+            probability_matrix_generate[j0:j0+tile.shape[1],i0:i0+tile.shape[0]]=tile.T
+
+    try:
+        score_tiles_parallel(_N,generate_data,link_prediction_head,consume,tile_size=tile_size,
+                             num_workers=1,device=device)
+        top_m_edges,_=top_m.result()
+        graphic_seq_generate=np.bincount(top_m_edges.reshape(-1),minlength=_N)
+        chunks=revised_Havel_Hakimmi_Algorithm(_N,_num_of_edges,dic,probability_matrix_generate,
+                                               graphic_seq_generate,output='chunks')
+        return _collect_edges(_N,chunks,adj_origin,edge_path)
+    finally:
+        del probability_matrix_generate
+        if temporary:
+            os.remove(probability_path)
+
+
+def _collect_edges(_N,chunks,adj_origin,edge_path):
+    if edge_path is not None:
+        with open_edge_sink(edge_path) as sink:
+            write_edge_chunks(chunks,sink)
+        return edge_path,None
+    chunks=list(chunks)
+    edges=np.concatenate(chunks) if chunks else np.zeros((0,2),dtype=np.int64)
+    return edges,_generate_metrics(_N,edges,adj_origin)
+
+
+def _generate_metrics(_N,edges,adj_origin):
+    if adj_origin is None:
+        return None
+    generate_graph=np.zeros((_N,_N))
+    generate_graph[edges[:,0],edges[:,1]]=1
+    generate_graph[edges[:,1],edges[:,0]]=1
+    metrics=compute_graph_statistics(generate_graph)
+    metrics['edge_overlap']=np.sum(adj_origin[edges[:,0],edges[:,1]])/(np.sum(adj_origin)/2)
+    return metrics
+
+
+def _generate_worker(idx):
+    state=_generate_worker_state
+    probability_path=None
+    if state['probability_dir'] is not None:
+        probability_path=os.path.join(state['probability_dir'],'probability%d.dat'%(idx))
+    edge_path=None
+    if state['edge_dir'] is not None:
+        edge_path=os.path.join(state['edge_dir'],'edges%d%s'%(idx,state['edge_format']))
+    edges,metrics=generate_one(idx,state['netG'],state['link_prediction_head'],state['_N'],
+                               state['_num_of_edges'],state['dic'],state['noise_dim'],seed=state['seed'],
+                               adj_origin=state['adj_origin'],embedding_columns=state['embedding_columns'],
+                               probability_path=probability_path,tile_size=state['tile_size'],
+                               device=state['device'],engine=state['engine'],edge_path=edge_path)
+    return idx,edges,metrics
+
+
+def generate_many(generate_number,netG,link_prediction_head,_N,_num_of_edges,dic,noise_dim,num_workers=None,
+                  threads_per_worker=1,seed=0,adj_origin=None,embedding_columns=None,probability_dir=None,
+                  tile_size=256,device='cpu',engine='havel_hakimi',edge_dir=None,edge_format='.bin'):
+    """
+    Generate several realizations on a process pool, yielding them as they finish.
+
+    Every realization runs generate_one in a spawned worker with its own seeded
+    stream, so the set of results only depends on seed. Probability matrices go
+    to memmaps in probability_dir (kept for inspection) or to temporary files.
+
+    Parameters
+    ----------
+    generate_number: int
+                     Number of realizations.
+    num_workers: int, default os.cpu_count()
+                 Number of worker processes.
+    threads_per_worker: int
+                        Torch intra-op threads of every worker.
+    embedding_columns: slice or None
+                       Columns of the GAN output fed to the link head (gene: slice(0,128)).
+    engine: str
+            'havel_hakimi' (exact degrees) or 'chung_lu' (sampled, no N^2 pass).
+    edge_dir: str or None
+              Stream the edges of realization idx to edge_dir/edges<idx><edge_format>
+              ('.bin' or '.npz') while it is generated; edges is then that path.
+
+    Yields
+    ------
+    (idx, edges, metrics) in completion order
+    """
+
+    if num_workers is None:
+        num_workers=os.cpu_count()
+    if probability_dir is not None and not os.path.exists(probability_dir):
+        os.makedirs(probability_dir)
+    if edge_dir is not None and not os.path.exists(edge_dir):
+        os.makedirs(edge_dir)
+    state={'netG':copy.deepcopy(netG).cpu(),'link_prediction_head':copy.deepcopy(link_prediction_head).cpu(),
+           '_N':_N,'_num_of_edges':_num_of_edges,'dic':{i:set(dic[i]) for i in range(_N)},
+           'noise_dim':noise_dim,'seed':seed,'adj_origin':adj_origin,'embedding_columns':embedding_columns,
+           'probability_dir':probability_dir,'tile_size':tile_size,'device':device,
+           'threads_per_worker':threads_per_worker,'engine':engine,
+           'edge_dir':edge_dir,'edge_format':edge_format}
+    context=multiprocessing.get_context('spawn')
+    with context.Pool(num_workers,initializer=_generate_worker_init,initargs=(state,)) as pool:
+        for result in pool.imap_unordered(_generate_worker,range(generate_number)):
+            print('\rrealization %d finished'%(result[0]),end="")
+            yield result
+
+
+#Parallel GAN training part
+
+def _gan_run_worker(queue,stop_event,save_idx,seed,threads_per_worker,quiet,embedding_matrix_numpy,gan_kwargs):
+    torch.set_num_threads(threads_per_worker)
+    if quiet:
+        sys.stdout=open(os.devnull,'w')
+    try:
+        flag,best_mmd=gan_train(embedding_matrix_numpy,save_idx=save_idx,seed=seed,best_suffix=str(save_idx),
+                                callback=lambda metrics: queue.put(('eval',save_idx,metrics)),
+                                stop_event=stop_event,**gan_kwargs)
+        queue.put(('finished',save_idx,(flag,best_mmd)))
+    except Exception:
+        queue.put(('error',save_idx,traceback.format_exc()))
+
+
+def gan_train_parallel(embedding_matrix_numpy,num_workers=None,threads_per_worker=1,seed=0,max_runs=None,
+                       patience=10,plateau_tol=0.01,collapse_limit=0.5,quiet=True,device='cuda',stop_timeout=60,
+                       **gan_kwargs):
+    """
+    Independent seeded gan_train restarts on a process pool until one meets mmd_best_criterion.
+
+    Replaces the sample_GAN notebook loop over save_idx: num_workers runs go at
+    once, run save_idx is seeded with seed+save_idx and keeps its best model in
+    gan_model/bestG<save_idx>.pth. Every evaluation is reported to the parent
+    through a queue; a run is killed and replaced by the next save_idx when its
+    collapse fraction reaches collapse_limit, or when its MMD has not improved
+    by plateau_tol (relative) over its last patience evaluations. As soon as a
+    run reaches the target all others are stopped and its best model is copied
+    to gan_model/bestG.pth and bestD.pth. A run that fails or dies stops all
+    others and raises RuntimeError with its traceback, instead of being retried.
+
+    Runs are stopped through an event that gan_train checks after every epoch,
+    so they never die halfway through a queue.put; a run is only terminated when
+    it has not returned stop_timeout seconds later.
+
+    Parameters
+    ----------
+    num_workers: int, default os.cpu_count()
+                 Number of concurrent runs.
+    threads_per_worker: int
+                        Torch intra-op threads of every run.
+    max_runs: int or None
+              Stop after this many runs (None: until the target is met).
+    device: str
+            Torch device every run trains and evaluates on.
+    stop_timeout: float
+                  Seconds a stopped run gets to return before it is terminated.
+    gan_kwargs:
+                Passed to gan_train (batch_size, mmd_beta, mmd_best_criterion, ...),
+                plot defaults to False.
+
+    Returns
+    -------
+    flag: True when a run met mmd_best_criterion
+    best_idx: save_idx of the run whose saved model is best, or None when no run
+              saved one (no MMD below mmd_criterion)
+    best_mmd: the MMD of that saved model, np.inf without one
+    """
+
+    if num_workers is None:
+        num_workers=os.cpu_count()
+    if not os.path.exists('gan_model/'):
+        os.makedirs('gan_model/')
+    gan_kwargs=dict(gan_kwargs,device=device)
+    gan_kwargs.setdefault('plot',False)
+    context=multiprocessing.get_context('spawn')
+    queue=context.Queue()
+    running={}
+    stop_events={}
+    history={}
+    best_idx,best_mmd,flag=None,np.inf,False
+    next_idx=0
+
+    def stop(save_idx,reason):
+        process=running.pop(save_idx)
+        stop_events.pop(save_idx).set()
+        process.join(stop_timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        print('run %d stopped: %s'%(save_idx,reason))
+
+    try:
+        while True:
+            while len(running)<num_workers and (max_runs is None or next_idx<max_runs):
+                # a best model left by an earlier session must not pass for this run's
+                for name in ('bestG','bestD'):
+                    if os.path.exists('gan_model/'+name+str(next_idx)+'.pth'):
+                        os.remove('gan_model/'+name+str(next_idx)+'.pth')
+                stop_events[next_idx]=context.Event()
+                process=context.Process(target=_gan_run_worker,daemon=True,
+                                        args=(queue,stop_events[next_idx],next_idx,seed+next_idx,threads_per_worker,
+                                              quiet,embedding_matrix_numpy,gan_kwargs))
+                process.start()
+                running[next_idx]=process
+                history[next_idx]=[]
+                next_idx+=1
+            if not running:
+                break
+            try:
+                kind,save_idx,payload=queue.get(timeout=10)
+            except Exception:
+                # a run that died without reporting (e.g. out of memory)
+                for save_idx in [i for i,process in running.items() if not process.is_alive()]:
+                    exitcode=running[save_idx].exitcode
+                    stop(save_idx,'exited with code %s'%(exitcode))
+                    raise RuntimeError('gan_train run %d exited with code %s'%(save_idx,exitcode))
+                continue
+            if save_idx not in running:
+                continue
+
+            if kind=='eval':
+                mmd=payload['mmd']
+                print('run %d epoch %d: mmd=%s,collapse=%f'%(save_idx,payload['epoch'],mmd,payload['collapse']))
+                if mmd is not None:
+                    history[save_idx].append(mmd)
+                    # only MMDs with a checkpoint behind them can be returned and copied
+                    if payload['saved'] and mmd<best_mmd:
+                        best_idx,best_mmd=save_idx,mmd
+                mmds=history[save_idx]
+                if payload['collapse']>=collapse_limit:
+                    stop(save_idx,'collapse')
+                elif len(mmds)>patience and min(mmds[-patience:])>(1-plateau_tol)*min(mmds[:-patience]):
+                    stop(save_idx,'plateau')
+            elif kind=='finished':
+                stop(save_idx,'finished, best mmd %f'%(payload[1]))
+                if payload[0]:
+                    flag=True
+                    best_idx,best_mmd=save_idx,payload[1]
+                    break
+            else:
+                stop(save_idx,'error')
+                raise RuntimeError('gan_train run %d failed:\n%s'%(save_idx,payload))
+    finally:
+        # signal every run first so they wind down together
+        for event in stop_events.values():
+            event.set()
+        for save_idx in list(running):
+            stop(save_idx,'target reached' if flag else 'shutdown')
+
+    if best_idx is not None and os.path.exists('gan_model/bestG'+str(best_idx)+'.pth'):
+        shutil.copyfile('gan_model/bestG'+str(best_idx)+'.pth','gan_model/bestG.pth')
+        shutil.copyfile('gan_model/bestD'+str(best_idx)+'.pth','gan_model/bestD.pth')
+    return flag,best_idx,best_mmd